@@ -61,6 +61,8 @@ def checkout(dbapi_con, con_record, con_proxy):
 
 cache = Cache(app, config=app.config.get('CACHE_CONFIG'))
 
+results_backend = app.config.get('RESULTS_BACKEND')
+
 migrate = Migrate(app, db, directory=APP_DIR + "/migrations")
 
 # Logging configuration
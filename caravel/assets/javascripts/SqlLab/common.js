@@ -1,6 +1,7 @@
 export const STATE_BSSTYLE_MAP = {
   failed: 'danger',
   pending: 'info',
+  queued: 'info',
   running: 'warning',
   success: 'success',
 };
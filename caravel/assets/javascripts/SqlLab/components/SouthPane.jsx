@@ -23,7 +23,7 @@ class SouthPane extends React.Component {
     let results = <div />;
     const latestQuery = this.props.latestQuery;
     if (latestQuery) {
-      if (['running', 'pending'].includes(latestQuery.state)) {
+      if (['running', 'pending', 'queued'].includes(latestQuery.state)) {
         results = (
           <img className="loading" alt="Loading.." src="/static/assets/images/loading.gif" />
         );
@@ -91,7 +91,12 @@ class SqlEditor extends React.Component {
       data: sqlJsonRequest,
       success(results) {
         if (!runAsync) {
-          that.props.actions.querySuccess(query, results);
+          if (results.status === 'stopped') {
+            // stopped by the user, not a failure
+            that.props.actions.stopQuery(query);
+          } else {
+            that.props.actions.querySuccess(query, results);
+          }
         }
       },
       error(err, textStatus, errorThrown) {
@@ -113,6 +118,13 @@ class SqlEditor extends React.Component {
     });
   }
   stopQuery() {
+    // the query gets cancelled on the database by the server
+    $.ajax({
+      type: 'POST',
+      dataType: 'json',
+      url: '/caravel/stop_query/',
+      data: { client_id: this.props.latestQuery.id },
+    });
     this.props.actions.stopQuery(this.props.latestQuery);
   }
   createTableAs() {
@@ -180,7 +192,10 @@ class SqlEditor extends React.Component {
         {runButtons}
       </ButtonGroup>
     );
-    if (this.props.latestQuery && this.props.latestQuery.state === 'running') {
+    if (
+      this.props.latestQuery &&
+      ['running', 'queued'].includes(this.props.latestQuery.state)
+    ) {
       runButtons = (
         <ButtonGroup bsSize="small" className="inline m-r-5 pull-left">
           <Button
@@ -1,11 +1,17 @@
+import base64
 import calendar
 import json
 import logging
+import os
+import threading
+import time
 from collections import namedtuple
 
 from datetime import datetime
+import numpy
 import pandas
 import requests
+from requests.adapters import HTTPAdapter
 from flask.ext.appbuilder import Model
 from sqlalchemy import Boolean
 from sqlalchemy import Column
@@ -26,6 +32,8 @@ from flask_appbuilder.models.mixins import AuditMixin
 from flask_appbuilder.models.decorators import renders
 from flask_babel import lazy_gettext as _
 
+config = caravel.app.config
+
 
 class CassandraCluster(Model, AuditMixinNullable):
     """ORM object referencing the cassandra clusters"""
@@ -81,17 +89,126 @@ class RestServerModel(Model, AuditMixinNullable):
         return RestClient(self, datasource)
 
     def refresh_datasources(self):
+        """Refreshes the metadata of all the datasources of the server
+
+        The metadata is fetched concurrently over REST_REFRESH_WORKERS
+        threads sharing the server's session, then merged in the db.
+        Returns the errors of the datasources that couldn't be fetched.
+        """
         session = get_session()
         datasources = (session.query(RestDatasourceModel)
                        .filter_by(server_url=self.server_url).all())
-        for d in datasources:
-            d.fetch_metadata()
+        clients = [(d, self.get_client(d)) for d in datasources]
+
+        def get_metadata(item):
+            datasource, client = item
+            try:
+                return datasource, client.get_metadata(), None
+            except Exception as e:
+                logging.exception(e)
+                return datasource, None, utils.error_msg_from_exception(e)
+
+        results = list(utils.parallel_imap(
+            get_metadata, clients,
+            workers=config.get('REST_REFRESH_WORKERS')))
+        errors = {}
+        for datasource, meta, error in results:
+            if error:
+                errors[datasource.full_name] = error
+                utils.flasher(
+                    "Couldn't fetch the metadata of {}: {}".format(
+                        datasource.full_name, error), "danger")
+            else:
+                datasource.fetch_metadata(meta)
+        return errors
 
     @property
     def perm(self):
         return "[{obj.server_url}].(id:{obj.id})".format(obj=self)
 
 
+class RestSession(object):
+    """Keeps the connections and the access token to a rest server alive
+
+    Connections are pooled, up to REST_POOL_SIZE per server. The access
+    token is reused until it expires or gets rejected by the server.
+    """
+
+    def __init__(self, server_url):
+        self.server_url = server_url
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_maxsize=config.get('REST_POOL_SIZE'))
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+        self.lock = threading.Lock()
+        self.token = None
+        self.token_expires = 0
+
+    def get_access_token(self, rejected=None):
+        """Returns the access token, logging in again when it's expired
+
+        :param rejected: a token the server rejected, renewed unless it
+            already was by another thread
+        """
+        with self.lock:
+            if (
+                    not self.token or self.token == rejected or
+                    self.token_expires < time.time()):
+                url = "http://%s/login" % (self.server_url)
+                resp = self.session.post(url, data={
+                    "username": config.get('REST_SERVER_USERNAME'),
+                    "password": config.get('REST_SERVER_PASSWORD'),
+                })
+                if not resp.ok:
+                    logging.error("Could not log in to {}: {}".format(
+                        self.server_url, resp.reason))
+                    return None
+                self.token = resp.json()['jwtToken']
+                self.token_expires = self.get_token_expiry(self.token)
+            return self.token
+
+    @staticmethod
+    def get_token_expiry(token):
+        """Reads the expiry of a JWT token, a bit ahead of time"""
+        try:
+            claims = token.split('.')[1]
+            claims += '=' * (-len(claims) % 4)
+            claims = json.loads(
+                base64.urlsafe_b64decode(claims.encode('ascii')).decode('utf-8'))
+            return claims['exp'] - 30
+        except Exception:
+            return time.time() + config.get('REST_TOKEN_TIMEOUT')
+
+    def get(self, url, **kwargs):
+        """Authenticated GET request, logs in again if the token is rejected"""
+        token = self.get_access_token()
+        resp = self.session.get(
+            url, headers={"Authorization": token}, **kwargs)
+        if resp.status_code == 401:
+            resp.close()
+            resp = self.session.get(
+                url,
+                headers={"Authorization": self.get_access_token(token)},
+                **kwargs)
+        return resp
+
+
+rest_sessions = {}
+rest_sessions_lock = threading.Lock()
+
+
+def get_rest_session(server_url):
+    """Returns the process-wide RestSession of a server"""
+    key = (os.getpid(), server_url)
+    with rest_sessions_lock:
+        if key not in rest_sessions:
+            # connections can't be shared with a forked parent process
+            for k in [k for k in rest_sessions if k[0] != key[0]]:
+                del rest_sessions[k]
+            rest_sessions[key] = RestSession(server_url)
+        return rest_sessions[key]
+
+
 class RestClient(object):
     API_URL = '/api/datasources/{db_type}/{db}/{table}'
 
@@ -100,19 +217,12 @@ class RestClient(object):
         self.db_type = datasource.database_type
         self.db = datasource.database_name
         self.table = datasource.table_name
-
-    def get_access_token_temp(self):
-        url = "http://%s/login" % (self.server_url)
-        resp = requests.post(url, data={"username": "admin", "password": "admin"})
-        if resp.ok:
-            return resp.json()['jwtToken']
-
+        self.session = get_rest_session(self.server_url)
 
     def get_metadata(self):
         url = "http://%s%s/meta" % (self.server_url,
                         self.API_URL.format(**self.__dict__))
-        access_token = self.get_access_token_temp()
-        resp = requests.get(url, headers={"Authorization": access_token})
+        resp = self.session.get(url)
         if resp.ok:
             logging.debug(resp.json())
         else:
@@ -125,20 +235,89 @@ class RestClient(object):
     def getDataframe(self, reqparams):
         url = "http://%s%s" % (self.server_url,
                                     self.API_URL.format(**self.__dict__))
-        resp = requests.get(url.rstrip("/"),
-                            params=reqparams,
-                            headers={"Authorization": self.get_access_token_temp()})
+        if config.get('REST_COLUMNAR_RESULTS'):
+            reqparams = dict(reqparams, result_format='columnar')
+        if config.get('REST_STREAM_RESULTS'):
+            return self.stream_dataframe(url.rstrip("/"), reqparams)
+        resp = self.session.get(url.rstrip("/"), params=reqparams)
         # TODO: json to df
-        print resp.reason
         result = resp.json()
         self.result = result['result']
         self.query_type = result['query_type']
         return self.export_pandas()
 
+    def stream_dataframe(self, url, reqparams):
+        """Decodes the response incrementally into a DataFrame
+
+        The rows of the result are appended to column buffers as they get
+        parsed, the response is never held as a whole. Rows past the
+        row_limit aren't read and the connection gets closed, columnar
+        results are parsed whole and truncated to the row_limit.
+        """
+        row_limit = reqparams.get('row_limit')
+        self.query_type = None
+        self.rows = 0
+        columns = {}
+        resp = self.session.get(url, params=reqparams, stream=True)
+        try:
+            if not resp.ok:
+                logging.error("{} {}".format(resp.status_code, resp.reason))
+            stream = utils.JSONObjectStream(
+                resp.iter_content(config.get('REST_STREAM_CHUNK_SIZE')),
+                'result')
+            for key, value in stream:
+                if key == 'query_type':
+                    self.query_type = value
+                elif key != 'result':
+                    continue
+                elif not stream.streaming:
+                    # columnar results, an object holding the values of
+                    # each column
+                    columns = {
+                        k: v[:row_limit] if row_limit else v
+                        for k, v in value.items()}
+                    self.rows = max([len(v) for v in value.values()] or [0])
+                elif isinstance(value.get('result'), list):
+                    # topN
+                    for res in value['result']:
+                        if row_limit and self.rows >= row_limit:
+                            break
+                        res['timestamp'] = value['timestamp']
+                        self.append_row(columns, res)
+                elif isinstance(value.get('result'), dict):
+                    # timeseries
+                    value['result']['timestamp'] = value['timestamp']
+                    self.append_row(columns, value['result'])
+                else:
+                    self.append_row(columns, value)
+                if row_limit and self.rows >= row_limit:
+                    logging.info(
+                        "Row limit of {} reached, dropping the rest of the "
+                        "results".format(row_limit))
+                    break
+        finally:
+            resp.close()
+        return pandas.DataFrame(columns)
+
+    def append_row(self, columns, row):
+        """Appends a row to the column buffers, padding missing values"""
+        for key, value in row.items():
+            if key not in columns:
+                columns[key] = [None] * self.rows
+            columns[key].append(value)
+        self.rows += 1
+        for values in columns.values():
+            if len(values) < self.rows:
+                values.append(None)
+
     def export_pandas(self):
         """
         Export the current query result to a Pandas DataFrame object.
 
+        Results are either a list of rows, shaped after the query type, or
+        columnar, a dict holding the list of values of each column, which
+        servers send when asked for the `columnar` result_format.
+
         :return: The DataFrame representing the query result
         :rtype: DataFrame
         :raise NotImplementedError:
@@ -166,25 +345,23 @@ class RestClient(object):
                     1      6  2013-10-04T00:00:00.000Z         user_2
         """
         if self.result:
+            if isinstance(self.result, dict):
+                # columnar results, a list of values per column
+                return pandas.DataFrame(self.result)
             if self.query_type == "timeseries":
-                nres = [list(v['result'].items()) + [('timestamp', v['timestamp'])]
-                        for v in self.result]
-                nres = [dict(v) for v in nres]
+                df = pandas.DataFrame.from_records(
+                    [v['result'] for v in self.result])
+                df['timestamp'] = [v['timestamp'] for v in self.result]
             elif self.query_type == "topN":
-                nres = []
-                for item in self.result:
-                    timestamp = item['timestamp']
-                    results = item['result']
-                    tres = [dict(list(res.items()) + [('timestamp', timestamp)])
-                            for res in results]
-                    nres += tres
+                df = pandas.DataFrame.from_records(
+                    [res for item in self.result for res in item['result']])
+                df['timestamp'] = numpy.repeat(
+                    [item['timestamp'] for item in self.result],
+                    [len(item['result']) for item in self.result])
             elif self.query_type == "groupby":
-                nres = [list(v.items()) for v in self.result]
-                nres = [dict(v) for v in nres]
+                df = pandas.DataFrame.from_records(self.result)
             else:
                 raise NotImplementedError('Pandas export not implemented for query type: {0}'.format(self.query_type))
-
-            df = pandas.DataFrame(nres)
             return df
 
 
@@ -206,6 +383,7 @@ class RestDatasourceModel(Model, AuditMixinNullable, Queryable):
     owner = relationship('User', backref='rest_datasources', foreign_keys=[user_id])
     offset = Column(Integer, default=0)
     cache_timeout = Column(Integer)
+    serve_stale = Column(Boolean)
     # server
     server_url = Column(String(250), ForeignKey('rest_server.server_url'))
     server = relationship('RestServerModel', backref='rest_datasources', foreign_keys=[server_url])
@@ -272,18 +450,25 @@ class RestDatasourceModel(Model, AuditMixinNullable, Queryable):
         )
         return grains
 
-    def fetch_metadata(self):
-        """ Fetch metadata from Rest datasource and save to db as RestColumns"""
+    def fetch_metadata(self, meta=None):
+        """ Fetch metadata from Rest datasource and save to db as RestColumns
+
+        :param meta: the metadata of the datasource, fetched when not provided
+        """
         session = get_session()
-        client = self.server.get_client(self)
-        meta = client.get_metadata()
+        if meta is None:
+            client = self.server.get_client(self)
+            meta = client.get_metadata()
         cols = meta['columns']
         if not cols:
             return
+        col_objs = {
+            col_obj.column_name: col_obj for col_obj in (
+                session.query(RestColumn).filter_by(datasource_id=self.id))
+        }
+        synced_cols = []
         for col in cols:
-            col_obj = (session.query(RestColumn)
-                           .filter_by(datasource_id=self.id, column_name=col)
-                           .first())
+            col_obj = col_objs.get(col)
             datatype = cols[col]['type']
             if not col_obj:
                 col_obj = RestColumn(datasource_id=self.id, column_name=col, type=cols[col]['type'])
@@ -294,11 +479,36 @@ class RestDatasourceModel(Model, AuditMixinNullable, Queryable):
                 col_obj.filterable = True
             if (cols[col].get('isDateTime', None)) or (datatype == "DATETIME") or (datatype == "TIMESTAMP"):
                 col_obj.is_dttm = True
-
-            session.flush()
             col_obj.datasource = self
-            col_obj.generate_metrics()
+            synced_cols.append(col_obj)
+        session.flush()
+        self.generate_metrics(synced_cols)
+
+    def generate_metrics(self, columns=None):
+        """Generates the metrics of the columns that the datasource lacks
+
+        :param columns: the columns to generate metrics for, defaults to all
+            the columns of the datasource
+        :return: the new metrics
+        """
+        M = RestMetric
+        session = get_session()
+        metric_names = {
+            metric_name for metric_name, in (
+                session.query(M.metric_name).filter(M.datasource_id == self.id))
+        }
+        new_metrics = []
+        for col in self.columns if columns is None else columns:
+            for metric in col.get_metrics():
+                if metric.metric_name not in metric_names:
+                    metric.datasource_id = self.id
+                    metric_names.add(metric.metric_name)
+                    new_metrics.append(metric)
+                    session.add(metric)
+        if new_metrics:
             session.flush()
+            utils.init_metrics_perm(caravel, new_metrics)
+        return new_metrics
 
     def query(
             self, groupby, metrics,
@@ -374,6 +584,10 @@ class RestColumn(Model, AuditMixinNullable):
 
     def generate_metrics(self):
         """Generate metric from column metadata and save to db"""
+        return self.datasource.generate_metrics([self])
+
+    def get_metrics(self):
+        """Returns the metrics that can be derived from the column"""
         M = RestMetric
         metrics = []
         metrics.append(M(
@@ -423,30 +637,13 @@ class RestColumn(Model, AuditMixinNullable):
             mt = 'count_distinct'
             metrics.append(M(
                 metric_name=name,
-                verbose_nam='COUNT(DISTINCT {})'.format(self.column_name),
+                verbose_name='COUNT(DISTINCT {})'.format(self.column_name),
                 metric_type='count_distinct',
-                json=json.dump({
+                json=json.dumps({
                     'type': 'cardinality', 'name': name, 'fieldNames': [self.column_name]
                 })
             ))
-
-        #save to db
-        session = get_session()
-        new_metrics = []
-        for metric in metrics:
-            m = (
-                session.query(M)
-                    .filter(M.metric_name == metric.metric_name)
-                    .filter(M.datasource_id == self.datasource_id)
-                    .filter(RestServerModel.server_url == self.datasource.server_url)
-                    .first())
-            metric.datasource_id = self.datasource_id
-            if not m:
-                new_metrics.append(metric)
-                session.add(metric)
-                session.flush()
-
-        utils.init_metrics_perm(caravel, new_metrics)
+        return metrics
 
 
 class RestMetric(Model, AuditMixinNullable):
@@ -157,7 +157,7 @@ class RestDatasourceModelView(CaravelModelView, DeleteMixin):
     add_columns = ['server', 'database_type', 'database_name',
                     'table_name', 'api_endpoint', 'description', 'owner',
                     'is_featured', 'is_hidden', 'offset',
-                    'cache_timeout']
+                    'cache_timeout', 'serve_stale']
     edit_columns = add_columns
     description_columns = {
         'description': Markup(
@@ -175,6 +175,7 @@ class RestDatasourceModelView(CaravelModelView, DeleteMixin):
         'api_endpoint': _("API Endpoint"),
         'offset': _("Time Offset"),
         'cache_timeout': _("Cache Timeout"),
+        'serve_stale': _("Serve Stale"),
         'database_type': _("Database Type"),
         'database_name': _("Database Name"),
         'table_type': _("Table Name"),
@@ -32,6 +32,10 @@ class CaravelDataFrame(object):
     def data(self):
         return self.__df.to_dict(orient='records')
 
+    @property
+    def columnar_data(self):
+        return self.__df.to_dict(orient='list')
+
     @property
     def columns_dict(self):
         """Provides metadata about columns for data visualization.
@@ -0,0 +1,24 @@
+"""results_key
+
+Revision ID: 0dd41ae07ab3
+Revises: 3e1b21cd94a4
+Create Date: 2016-10-24 15:21:09.538126
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '0dd41ae07ab3'
+down_revision = '3e1b21cd94a4'
+
+from alembic import op
+import sqlalchemy as sa
+
+
+def upgrade():
+    op.add_column('query', sa.Column('results_key', sa.String(length=64), nullable=True))
+    op.create_index(op.f('ix_query_results_key'), 'query', ['results_key'], unique=False)
+
+
+def downgrade():
+    op.drop_index(op.f('ix_query_results_key'), table_name='query')
+    op.drop_column('query', 'results_key')
@@ -0,0 +1,28 @@
+"""serve_stale
+
+Revision ID: 3e1b21cd94a4
+Revises: 54714cda3489
+Create Date: 2016-10-20 11:02:41.214872
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '3e1b21cd94a4'
+down_revision = '54714cda3489'
+
+from alembic import op
+import sqlalchemy as sa
+
+
+def upgrade():
+    op.add_column('datasources', sa.Column('serve_stale', sa.Boolean(), nullable=True))
+    op.add_column('rest_datasources', sa.Column('serve_stale', sa.Boolean(), nullable=True))
+    op.add_column('slices', sa.Column('serve_stale', sa.Boolean(), nullable=True))
+    op.add_column('tables', sa.Column('serve_stale', sa.Boolean(), nullable=True))
+
+
+def downgrade():
+    op.drop_column('tables', 'serve_stale')
+    op.drop_column('slices', 'serve_stale')
+    op.drop_column('rest_datasources', 'serve_stale')
+    op.drop_column('datasources', 'serve_stale')
@@ -6,10 +6,14 @@ from __future__ import unicode_literals
 import re
 
 import functools
+import hashlib
 import json
 import logging
+import os
 import re
 import textwrap
+import threading
+import time
 from collections import namedtuple
 from copy import deepcopy, copy
 from datetime import timedelta, datetime, date
@@ -49,7 +53,7 @@ from sqlalchemy_utils import EncryptedType
 from werkzeug.datastructures import ImmutableMultiDict
 
 import caravel
-from caravel import app, db, get_session, utils, sm
+from caravel import app, cache, db, get_session, utils, sm
 from caravel.source_registry import SourceRegistry
 from caravel.viz import viz_types
 from caravel.utils import flasher, MetricPermException, DimSelector
@@ -71,6 +75,18 @@ class JavascriptPostAggregator(Postaggregator):
         self.name = name
 
 
+class InFilter(Filter):
+    """Filter matching the rows of a dimension whose value is in a list
+
+    Only supported by Druid 0.9.0 onwards"""
+    def __init__(self, dimension, values):
+        self.filter = {'filter': {
+            'type': 'in',
+            'dimension': dimension,
+            'values': values,
+        }}
+
+
 class AuditMixinNullable(AuditMixin):
     """Altering the AuditMixin to use nullable fields
 
@@ -160,6 +176,7 @@ class Slice(Model, AuditMixinNullable):
     params = Column(Text)
     description = Column(Text)
     cache_timeout = Column(Integer)
+    serve_stale = Column(Boolean)
     perm = Column(String(2000))
     owners = relationship("User", secondary=slice_user)
 
@@ -401,6 +418,50 @@ class Queryable(object):
             return "/caravel/explore/{obj.type}/{obj.id}/".format(obj=self)
 
 
+class EngineRegistry(object):
+
+    """Process-wide registry of pooled SQLAlchemy engines
+
+    Engines are keyed on ``(database_id, schema, params_hash)`` where the
+    hash covers the connection URI and the engine parameters. Editing a
+    ``Database`` therefore yields a new key, even in processes that never
+    saw the update, and the outdated engine for the same database and
+    schema gets disposed of when it's replaced.
+    """
+
+    def __init__(self):
+        self._engines = {}
+        self._lock = threading.Lock()
+        self._pid = os.getpid()
+
+    def get(self, key, factory):
+        """Returns the engine for ``key``, creating it with ``factory``"""
+        with self._lock:
+            if self._pid != os.getpid():
+                # Pooled connections can't be shared with a forked parent,
+                # drop the references without closing the sockets
+                self._engines = {}
+                self._pid = os.getpid()
+            engine = self._engines.get(key)
+            if engine is None:
+                stale = [k for k in self._engines if k[:2] == key[:2]]
+                for k in stale:
+                    self._engines.pop(k).dispose()
+                engine = factory()
+                self._engines[key] = engine
+            return engine
+
+    def invalidate(self, database_id):
+        """Disposes of all the engines of a database"""
+        with self._lock:
+            keys = [k for k in self._engines if k[0] == database_id]
+            for k in keys:
+                self._engines.pop(k).dispose()
+
+
+engines = EngineRegistry()
+
+
 class Database(Model, AuditMixinNullable):
     """An ORM object that stores Database related information"""
 
@@ -449,7 +510,88 @@ class Database(Model, AuditMixinNullable):
                 url.database += '/' + schema
         elif schema:
             url.database = schema
-        return create_engine(url, **params)
+        if self.id is None:
+            return self._create_engine(url, params)
+        params_hash = hashlib.md5(json.dumps(
+            [str(url), params], sort_keys=True, default=str,
+        ).encode('utf-8')).hexdigest()
+        return engines.get(
+            (self.id, schema, params_hash),
+            functools.partial(self._create_engine, url, params))
+
+    @staticmethod
+    def _create_engine(url, params):
+        """Creates a pooled engine, ``engine_params`` take precedence"""
+        params = dict(params)
+        backend = url.get_backend_name()
+        if backend != 'sqlite' and 'poolclass' not in params:
+            # sqlite defaults to a NullPool/SingletonThreadPool which
+            # don't take any sizing arguments
+            params.setdefault('pool_size', config.get('DB_POOL_SIZE'))
+            params.setdefault(
+                'max_overflow', config.get('DB_POOL_MAX_OVERFLOW'))
+        params.setdefault('pool_recycle', config.get('DB_POOL_RECYCLE'))
+        engine = create_engine(url, **params)
+        if config.get('DB_POOL_PRE_PING') and backend != 'presto':
+            # Presto connections are stateless HTTP calls, nothing to ping
+            sqla.event.listen(engine, 'checkout', utils.ping_connection)
+        return engine
+
+    def query_slots(self, user_id=None, low_priority=False, timeout=None,
+                    on_wait=None):
+        """Caps the number of queries running at once against the database
+
+        Returns the slots to hold while querying the database, overall and
+        for the user, as limited by ``concurrency_limit`` in ``extra`` or
+        DB_CONCURRENCY_LIMIT, and by DB_CONCURRENCY_LIMIT_PER_USER.
+        """
+        slot_timeout = config.get('DB_CONCURRENCY_SLOT_TIMEOUT')
+        semaphores = []
+        limit = self.get_extra().get(
+            'concurrency_limit', config.get('DB_CONCURRENCY_LIMIT'))
+        if limit:
+            semaphores.append(utils.CacheSemaphore(
+                cache, 'database_{}_queries'.format(self.id), int(limit),
+                timeout=slot_timeout,
+                reserved=config.get('DB_CONCURRENCY_RESERVED_SLOTS')))
+        user_limit = config.get('DB_CONCURRENCY_LIMIT_PER_USER')
+        if user_limit and user_id:
+            semaphores.append(utils.CacheSemaphore(
+                cache, 'database_{}_user_{}_queries'.format(self.id, user_id),
+                user_limit, timeout=slot_timeout))
+        return utils.SemaphoreSlots(
+            semaphores, low_priority=low_priority, timeout=timeout,
+            on_wait=on_wait)
+
+    def get_connection_id(self, conn):
+        """Returns the id of the connection on the database's side
+
+        It is needed to cancel the query running on the connection from
+        another one, None when the backend doesn't need it.
+        """
+        sql = {
+            'mysql': 'SELECT CONNECTION_ID()',
+            'postgresql': 'SELECT pg_backend_pid()',
+        }.get(self.backend)
+        if sql:
+            return conn.execute(sql).scalar()
+
+    @staticmethod
+    def cancel_query(engine, cursor, connection_id):
+        """Cancels the query running on the cursor or connection
+
+        Only relies on the engine, as it is called from another thread than
+        the one running the query.
+        """
+        backend = engine.url.get_backend_name()
+        if backend == 'presto':
+            if cursor:
+                cursor.cancel()
+        elif backend == 'mysql' and connection_id:
+            engine.execute('KILL QUERY {}'.format(int(connection_id)))
+        elif backend == 'postgresql' and connection_id:
+            engine.execute(
+                'SELECT pg_cancel_backend({})'.format(int(connection_id)))
 
     def get_df(self, sql, schema):
         eng = self.get_sqla_engine(schema=schema)
@@ -656,6 +798,14 @@ class Database(Model, AuditMixinNullable):
             "[{obj.database_name}].(id:{obj.id})").format(obj=self)
 
 
+def invalidate_engines(mapper, connection, target):  # noqa
+    engines.invalidate(target.id)
+
+
+sqla.event.listen(Database, 'after_update', invalidate_engines)
+sqla.event.listen(Database, 'after_delete', invalidate_engines)
+
+
 class SqlaTable(Model, Queryable, AuditMixinNullable):
     """An ORM object for SqlAlchemy table references"""
 
@@ -675,6 +825,7 @@ class SqlaTable(Model, Queryable, AuditMixinNullable):
         'Database', backref='tables', foreign_keys=[database_id])
     offset = Column(Integer, default=0)
     cache_timeout = Column(Integer)
+    serve_stale = Column(Boolean)
     schema = Column(String(255))
     sql = Column(Text)
     table_columns = relationship("TableColumn", back_populates="table")
@@ -947,7 +1098,12 @@ class SqlaTable(Model, Queryable, AuditMixinNullable):
         return self.database.get_table(self.table_name, schema=self.schema)
 
     def fetch_metadata(self):
-        """Fetches the metadata for the table and merges it in"""
+        """Fetches the metadata for the table and merges it in
+
+        The existing columns and metrics are loaded at once and all the
+        changes are committed in a single transaction. Returns the names of
+        the added and changed columns, and of the added metrics.
+        """
         try:
             table = self.get_sqla_table_object()
         except Exception:
@@ -957,6 +1113,23 @@ class SqlaTable(Model, Queryable, AuditMixinNullable):
 
         TC = TableColumn  # noqa shortcut to class
         M = SqlMetric  # noqa
+        db.session.merge(self)
+        db.session.flush()
+        dbcols = {}
+        dbmetrics = set()
+        if self.id:
+            dbcols = {
+                dbcol.column_name: dbcol
+                for dbcol in db.session.query(TC).filter(TC.table_id == self.id)
+            }
+            dbmetrics = {
+                metric_name for metric_name, in (
+                    db.session.query(M.metric_name)
+                    .filter(M.table_id == self.id)
+                )
+            }
+        added_columns = []
+        changed_columns = []
         metrics = []
         any_date_col = None
         for col in table.columns:
@@ -967,23 +1140,18 @@ class SqlaTable(Model, Queryable, AuditMixinNullable):
                 logging.error(
                     "Unrecognized data type in {}.{}".format(table, col.name))
                 logging.exception(e)
-            dbcol = (
-                db.session
-                    .query(TC)
-                    .filter(TC.table == self)
-                    .filter(TC.column_name == col.name)
-                    .first()
-            )
-            db.session.flush()
+            dbcol = dbcols.get(col.name)
             if not dbcol:
                 dbcol = TableColumn(column_name=col.name, type=datatype)
                 dbcol.groupby = dbcol.is_string
                 dbcol.filterable = dbcol.is_string
                 dbcol.sum = dbcol.isnum
                 dbcol.is_dttm = dbcol.is_time
-
-            db.session.merge(self)
-            self.columns.append(dbcol)
+                self.columns.append(dbcol)
+                dbcols[col.name] = dbcol
+                added_columns.append(col.name)
+            elif dbcol.type != datatype:
+                changed_columns.append(col.name)
 
             if not any_date_col and dbcol.is_time:
                 any_date_col = col.name
@@ -1019,8 +1187,6 @@ class SqlaTable(Model, Queryable, AuditMixinNullable):
                     expression="COUNT(DISTINCT {})".format(quoted)
                 ))
             dbcol.type = datatype
-            db.session.merge(self)
-            db.session.commit()
 
         metrics.append(M(
             metric_name='count',
@@ -1028,19 +1194,26 @@ class SqlaTable(Model, Queryable, AuditMixinNullable):
             metric_type='count',
             expression="COUNT(*)"
         ))
+        added_metrics = []
         for metric in metrics:
-            m = (
-                db.session.query(M)
-                    .filter(M.metric_name == metric.metric_name)
-                    .filter(M.table_id == self.id)
-                    .first()
-            )
-            metric.table_id = self.id
-            if not m:
-                db.session.add(metric)
-                db.session.commit()
+            if metric.metric_name not in dbmetrics:
+                self.metrics.append(metric)
+                dbmetrics.add(metric.metric_name)
+                added_metrics.append(metric.metric_name)
         if not self.main_dttm_col:
             self.main_dttm_col = any_date_col
+        db.session.merge(self)
+        db.session.commit()
+        logging.info(
+            "Synced the metadata of [{}], added columns: {}, changed "
+            "columns: {}, added metrics: {}".format(
+                self.table_name, added_columns, changed_columns,
+                added_metrics))
+        return {
+            'added_columns': added_columns,
+            'changed_columns': changed_columns,
+            'added_metrics': added_metrics,
+        }
 
 
 class SqlMetric(Model, AuditMixinNullable):
@@ -1198,10 +1371,52 @@ class DruidCluster(Model, AuditMixinNullable):
         return json.loads(requests.get(endpoint).text)['version']
 
     def refresh_datasources(self):
+        """Refreshes the metadata of all the datasources of the cluster
+
+        The segment metadata of the datasources is fetched from the broker
+        concurrently, over DRUID_REFRESH_WORKERS threads, and merged in the
+        db from the calling thread as it comes. Returns the seconds spent
+        fetching and syncing each datasource, and the error if any.
+        """
         self.druid_version = self.get_druid_version()
-        for datasource in self.get_datasources():
-            if datasource not in config.get('DRUID_DATA_SOURCE_BLACKLIST'):
-                DruidDatasource.sync_to_db(datasource, self)
+        druid_version = self.druid_version
+        datasources = [
+            (datasource, self.get_pydruid_client())
+            for datasource in self.get_datasources()
+            if datasource not in config.get('DRUID_DATA_SOURCE_BLACKLIST')]
+
+        def fetch_metadata(item):
+            name, client = item
+            start = time.time()
+            try:
+                cols = DruidDatasource.get_latest_metadata(
+                    client, name, druid_version)
+                error = None
+            except Exception as e:
+                logging.exception(e)
+                cols = None
+                error = utils.error_msg_from_exception(e)
+            return name, cols, error, time.time() - start
+
+        timings = {}
+        for name, cols, error, fetch_duration in utils.parallel_imap(
+                fetch_metadata, datasources,
+                workers=config.get('DRUID_REFRESH_WORKERS')):
+            start = time.time()
+            if error:
+                flasher(
+                    "Couldn't fetch the metadata of datasource [{}]: {}".format(
+                        name, error), "danger")
+            else:
+                DruidDatasource.sync_to_db(name, self, cols or {})
+            timings[name] = {
+                'fetch': round(fetch_duration, 3),
+                'sync': round(time.time() - start, 3),
+                'error': error,
+            }
+        logging.info("Refreshed the datasources of [{}]: {}".format(
+            self.cluster_name, timings))
+        return timings
 
     @property
     def perm(self):
@@ -1230,6 +1445,7 @@ class DruidDatasource(Model, AuditMixinNullable, Queryable):
         'DruidCluster', backref='datasources', foreign_keys=[cluster_name])
     offset = Column(Integer, default=0)
     cache_timeout = Column(Integer)
+    serve_stale = Column(Boolean)
 
     @property
     def metrics_combo(self):
@@ -1314,8 +1530,17 @@ class DruidDatasource(Model, AuditMixinNullable, Queryable):
 
     def latest_metadata(self):
         """Returns segment metadata from the latest segment"""
-        client = self.cluster.get_pydruid_client()
-        results = client.time_boundary(datasource=self.datasource_name)
+        return self.get_latest_metadata(
+            self.cluster.get_pydruid_client(), self.datasource_name,
+            self.cluster.druid_version)
+
+    @classmethod
+    def get_latest_metadata(cls, client, datasource_name, druid_version):
+        """Fetches the segment metadata of the latest segment
+
+        Only talks to the broker, so that it can be called from any thread.
+        """
+        results = client.time_boundary(datasource=datasource_name)
         if not results:
             return
         max_time = results[0]['result']['maxTime']
@@ -1324,18 +1549,45 @@ class DruidDatasource(Model, AuditMixinNullable, Queryable):
         # we need to set this interval to more than 1 day ago to exclude
         # realtime segments, which trigged a bug (fixed in druid 0.8.2).
         # https://groups.google.com/forum/#!topic/druid-user/gVCqqspHqOQ
-        start = (0 if self.version_higher(self.cluster.druid_version, '0.8.2') else 1)
+        start = (0 if cls.version_higher(druid_version, '0.8.2') else 1)
         intervals = (max_time - timedelta(days=7)).isoformat() + '/'
         intervals += (max_time - timedelta(days=start)).isoformat()
         segment_metadata = client.segment_metadata(
-            datasource=self.datasource_name,
+            datasource=datasource_name,
             intervals=intervals)
         if segment_metadata:
             return segment_metadata[-1]['columns']
 
-    def generate_metrics(self):
-        for col in self.columns:
-            col.generate_metrics()
+    def generate_metrics(self, columns=None):
+        """Generates the metrics of the columns that the datasource lacks
+
+        The names of the existing metrics are fetched at once and the new
+        metrics are added in a single flush.
+
+        :param columns: the columns to generate metrics for, defaults to all
+            the columns of the datasource
+        :return: the new metrics
+        """
+        M = DruidMetric  # noqa
+        session = get_session()
+        metric_names = {
+            metric_name for metric_name, in (
+                session.query(M.metric_name)
+                .filter(M.datasource_name == self.datasource_name)
+            )
+        }
+        new_metrics = []
+        for col in self.columns if columns is None else columns:
+            for metric in col.get_metrics():
+                if metric.metric_name not in metric_names:
+                    metric.datasource_name = self.datasource_name
+                    metric_names.add(metric.metric_name)
+                    new_metrics.append(metric)
+                    session.add(metric)
+        if new_metrics:
+            session.flush()
+            utils.init_metrics_perm(caravel, new_metrics)
+        return new_metrics
 
     @classmethod
     def sync_to_db_from_config(cls, druid_config, user, cluster):
@@ -1357,15 +1609,23 @@ class DruidDatasource(Model, AuditMixinNullable, Queryable):
             )
             session.add(datasource)
 
+        col_names = {
+            column_name for column_name, in (
+                session.query(DruidColumn.column_name)
+                .filter_by(datasource_name=druid_config['name'])
+            )
+        }
+        metric_names = {
+            metric_name for metric_name, in (
+                session.query(DruidMetric.metric_name)
+                .filter_by(datasource_name=druid_config['name'])
+            )
+        }
+
         dimensions = druid_config['dimensions']
         for dim in dimensions:
-            col_obj = (
-                session.query(DruidColumn)
-                    .filter_by(
-                    datasource_name=druid_config['name'],
-                    column_name=dim)
-            ).first()
-            if not col_obj:
+            if dim not in col_names:
+                col_names.add(dim)
                 col_obj = DruidColumn(
                     datasource_name=druid_config['name'],
                     column_name=dim,
@@ -1390,13 +1650,8 @@ class DruidDatasource(Model, AuditMixinNullable, Queryable):
                     "fieldName": metric_name,
                 })
 
-            metric_obj = (
-                session.query(DruidMetric)
-                    .filter_by(
-                    datasource_name=druid_config['name'],
-                    metric_name=metric_name)
-            ).first()
-            if not metric_obj:
+            if metric_name not in metric_names:
+                metric_names.add(metric_name)
                 metric_obj = DruidMetric(
                     metric_name=metric_name,
                     metric_type=metric_type,
@@ -1411,8 +1666,12 @@ class DruidDatasource(Model, AuditMixinNullable, Queryable):
         session.commit()
 
     @classmethod
-    def sync_to_db(cls, name, cluster):
-        """Fetches metadata for that datasource and merges the Caravel db"""
+    def sync_to_db(cls, name, cluster, cols=None):
+        """Fetches metadata for that datasource and merges the Caravel db
+
+        :param cols: the latest segment metadata of the datasource, fetched
+            when not provided
+        """
         logging.info("Syncing Druid datasource [{}]".format(name))
         session = get_session()
         datasource = session.query(cls).filter_by(datasource_name=name).first()
@@ -1426,16 +1685,17 @@ class DruidDatasource(Model, AuditMixinNullable, Queryable):
         datasource.cluster = cluster
         session.flush()
 
-        cols = datasource.latest_metadata()
+        if cols is None:
+            cols = datasource.latest_metadata()
         if not cols:
             return
+        col_objs = {
+            col_obj.column_name: col_obj for col_obj in (
+                session.query(DruidColumn).filter_by(datasource_name=name))
+        }
+        synced_cols = []
         for col in cols:
-            col_obj = (
-                session
-                    .query(DruidColumn)
-                    .filter_by(datasource_name=name, column_name=col)
-                    .first()
-            )
+            col_obj = col_objs.get(col)
             datatype = cols[col]['type']
             if not col_obj:
                 col_obj = DruidColumn(datasource_name=name, column_name=col)
@@ -1445,12 +1705,11 @@ class DruidDatasource(Model, AuditMixinNullable, Queryable):
                 col_obj.filterable = True
             if datatype == "hyperUnique" or datatype == "thetaSketch":
                 col_obj.count_distinct = True
-            if col_obj:
-                col_obj.type = cols[col]['type']
-            session.flush()
+            col_obj.type = datatype
             col_obj.datasource = datasource
-            col_obj.generate_metrics()
-            session.flush()
+            synced_cols.append(col_obj)
+        session.flush()
+        datasource.generate_metrics(synced_cols)
 
     def query(  # druid
             self, groupby, metrics,
@@ -1563,22 +1822,32 @@ class DruidDatasource(Model, AuditMixinNullable, Queryable):
 
         client = self.cluster.get_pydruid_client()
         orig_filters = filters
+        order_by = metrics[0] if metrics else self.metrics[0].metric_name
         if timeseries_limit and is_timeseries:
             # Limit on the number of timeseries, doing a two-phases query
             pre_qry = deepcopy(qry)
             pre_qry['granularity'] = "all"
-            pre_qry['limit_spec'] = {
-                "type": "default",
-                "limit": timeseries_limit,
-                'intervals': (
-                    inner_from_dttm.isoformat() + '/' +
-                    inner_to_dttm.isoformat()),
-                "columns": [{
-                    "dimension": metrics[0] if metrics else self.metrics[0],
-                    "direction": "descending",
-                }],
-            }
-            client.groupby(**pre_qry)
+            pre_query_type = self.get_query_type(
+                groupby, "all", timeseries_limit, having_filters)
+            if pre_query_type == 'topN':
+                del pre_qry['dimensions']
+                pre_qry['dimension'] = groupby[0]
+                pre_qry['metric'] = order_by
+                pre_qry['threshold'] = timeseries_limit
+                client.topn(**pre_qry)
+            else:
+                pre_qry['limit_spec'] = {
+                    "type": "default",
+                    "limit": timeseries_limit,
+                    'intervals': (
+                        inner_from_dttm.isoformat() + '/' +
+                        inner_to_dttm.isoformat()),
+                    "columns": [{
+                        "dimension": order_by,
+                        "direction": "descending",
+                    }],
+                }
+                client.groupby(**pre_qry)
             query_str += "// Two phase query\n// Phase 1\n"
             query_str += json.dumps(
                 client.query_builder.last_query.query_dict, indent=2) + "\n"
@@ -1586,20 +1855,8 @@ class DruidDatasource(Model, AuditMixinNullable, Queryable):
             df = client.export_pandas()
             if df is not None and not df.empty:
                 dims = qry['dimensions']
-                filters = []
-                for unused, row in df.iterrows():
-                    fields = []
-                    for dim in dims:
-                        f = Dimension(dim) == row[dim]
-                        fields.append(f)
-                    if len(fields) > 1:
-                        filt = Filter(type="and", fields=fields)
-                        filters.append(filt)
-                    elif fields:
-                        filters.append(fields[0])
-
-                if filters:
-                    ff = Filter(type="or", fields=filters)
+                if dims:
+                    ff = self.get_series_filter(df[dims].fillna(''), dims)
                     if not orig_filters:
                         qry['filter'] = ff
                     else:
@@ -1607,21 +1864,44 @@ class DruidDatasource(Model, AuditMixinNullable, Queryable):
                             ff,
                             orig_filters])
                 qry['limit_spec'] = None
-        if row_limit:
-            qry['limit_spec'] = {
-                "type": "default",
-                "limit": row_limit,
-                "columns": [{
-                    "dimension": metrics[0] if metrics else self.metrics[0],
-                    "direction": "descending",
-                }],
-            }
-        client.groupby(**qry)
+        query_type = self.get_query_type(
+            groupby, granularity, row_limit, having_filters)
+        if query_type == 'timeseries':
+            del qry['dimensions']
+            qry.pop('limit_spec', None)
+            # groupBy queries don't return empty buckets either
+            qry['context'] = {'skipEmptyBuckets': True}
+            client.timeseries(**qry)
+        elif query_type == 'topN':
+            del qry['dimensions']
+            qry.pop('limit_spec', None)
+            qry['dimension'] = groupby[0]
+            qry['metric'] = order_by
+            qry['threshold'] = row_limit
+            client.topn(**qry)
+        else:
+            if row_limit:
+                qry['limit_spec'] = {
+                    "type": "default",
+                    "limit": row_limit,
+                    "columns": [{
+                        "dimension": order_by,
+                        "direction": "descending",
+                    }],
+                }
+            client.groupby(**qry)
         query_str += json.dumps(
             client.query_builder.last_query.query_dict, indent=2)
         df = client.export_pandas()
         if df is None or df.size == 0:
             raise Exception(_("No data was returned."))
+        if (
+                query_type == 'timeseries' and row_limit and
+                len(df) > row_limit and order_by in df.columns):
+            # the buckets with the top values are kept, as with the ordered
+            # limit_spec of the groupBy queries, in time order
+            df = df.sort_values(order_by, ascending=False)[:row_limit]
+            df = df.sort_index()
 
         if (
                 not is_timeseries and
@@ -1641,6 +1921,62 @@ class DruidDatasource(Model, AuditMixinNullable, Queryable):
             query=query_str,
             duration=datetime.now() - qry_start_dttm)
 
+    @staticmethod
+    def get_query_type(groupby, granularity, row_limit, having_filters):
+        """Returns the cheapest Druid query type able to run a query
+
+        >>> print(DruidDatasource.get_query_type([], 'all', 100, None))
+        timeseries
+        >>> print(DruidDatasource.get_query_type(['dim'], 'all', 100, None))
+        topN
+        >>> print(DruidDatasource.get_query_type(['dim'], 'all', None, None))
+        groupBy
+        >>> print(DruidDatasource.get_query_type(['a', 'b'], 'all', 100, None))
+        groupBy
+        """
+        if having_filters:
+            return 'groupBy'
+        if not groupby:
+            return 'timeseries'
+        if (
+                len(groupby) == 1 and
+                row_limit and
+                granularity == "all" and
+                config.get('DRUID_USE_TOPN')):
+            return 'topN'
+        return 'groupBy'
+
+    def get_in_filter(self, dim, values):
+        """Returns a filter matching the rows of dim whose value is in values
+
+        Falls back on an ``or`` of selectors for Druid versions lacking
+        the ``in`` filter"""
+        if len(values) == 1:
+            return Dimension(dim) == values[0]
+        druid_version = self.cluster.druid_version if self.cluster else None
+        if druid_version and not self.version_higher('0.9.0', druid_version):
+            return InFilter(dim, values)
+        return Filter(type="or", fields=[Dimension(dim) == v for v in values])
+
+    def get_series_filter(self, df, dims):
+        """Returns a filter matching the series of a dataframe
+
+        The series are grouped by the value of their first dimension, the
+        remaining dimensions being matched recursively so that the last one
+        ends up in a single ``in`` filter per group"""
+        dim = dims[0]
+        if len(dims) == 1:
+            return self.get_in_filter(dim, df[dim].unique().tolist())
+        fields = [
+            Filter(type="and", fields=[
+                Dimension(dim) == value,
+                self.get_series_filter(group, dims[1:]),
+            ])
+            for value, group in df.groupby(dim, sort=False)]
+        if len(fields) == 1:
+            return fields[0]
+        return Filter(type="or", fields=fields)
+
     @staticmethod
     def get_filters(raw_filters):
         filters = None
@@ -1827,7 +2163,10 @@ class DruidColumn(Model, AuditMixinNullable):
 
     def generate_metrics(self):
         """Generate metrics based on the column metadata"""
-        M = DruidMetric  # noqa
+        return self.datasource.generate_metrics([self])
+
+    def get_metrics(self):
+        """Returns the metrics that can be derived from the column"""
         metrics = []
         metrics.append(DruidMetric(
             metric_name='count',
@@ -1895,23 +2234,7 @@ class DruidColumn(Model, AuditMixinNullable):
                         'name': name,
                         'fieldNames': [self.column_name]})
                 ))
-        session = get_session()
-        new_metrics = []
-        for metric in metrics:
-            m = (
-                session.query(M)
-                    .filter(M.metric_name == metric.metric_name)
-                    .filter(M.datasource_name == self.datasource_name)
-                    .filter(DruidCluster.cluster_name == self.datasource.cluster_name)
-                    .first()
-            )
-            metric.datasource_name = self.datasource_name
-            if not m:
-                new_metrics.append(metric)
-                session.add(metric)
-                session.flush()
-
-        utils.init_metrics_perm(caravel, new_metrics)
+        return metrics
 
 
 class FavStar(Model):
@@ -1928,8 +2251,10 @@ class QueryStatus:
     CANCELLED = 'cancelled'
     FAILED = 'failed'
     PENDING = 'pending'
+    QUEUED = 'queued'
     RUNNING = 'running'
     SCHEDULED = 'scheduled'
+    STOPPED = 'stopped'
     SUCCESS = 'success'
     TIMED_OUT = 'timed_out'
 
@@ -1967,6 +2292,8 @@ class Query(Model):
     # # of rows in the result set or rows modified.
     rows = Column(Integer)
     error_message = Column(Text)
+    # key of the results of the async queries in the results backend
+    results_key = Column(String(64), index=True)
 
     # Using Numeric in place of DateTime for sub-second precision
     # stored as seconds since epoch, allowing for milliseconds
@@ -2009,6 +2336,7 @@ class Query(Model):
             'tempTable': self.tmp_table_name,
             'userId': self.user_id,
             'limit_reached': self.limit_reached,
+            'resultsKey': self.results_key,
         }
 
     @property
@@ -1,11 +1,19 @@
 import celery
 from datetime import datetime
+import hashlib
+import json
 import pandas as pd
 import logging
+import numbers
 import numpy
+import threading
 import time
+import uuid
+import zlib
 
-from caravel import app, db, models, utils, dataframe
+from sqlalchemy import select
+
+from caravel import app, db, models, utils, dataframe, results_backend
 
 QueryStatus = models.QueryStatus
 
@@ -43,9 +51,217 @@ def create_table_as(sql, table_name, schema=None, override=False):
     return exec_sql.format(**locals())
 
 
+def fetch_chunks(result_proxy, chunk_size, limit=None):
+    """Yields the rows of the results by chunks of chunk_size rows
+
+    :param limit: the number of rows after which to stop fetching, the rest
+        of the results being discarded
+    """
+    fetched = 0
+    while not limit or fetched < limit:
+        size = min(chunk_size, limit - fetched) if limit else chunk_size
+        rows = result_proxy.fetchmany(size)
+        if not rows:
+            break
+        fetched += len(rows)
+        yield rows
+    result_proxy.close()
+
+
+def get_query_status(engine, query_id):
+    """Reads the status of the query as committed in the metadata database"""
+    table = models.Query.__table__
+    qry = select([table.c.status]).where(table.c.id == query_id)
+    return engine.execute(qry).scalar()
+
+
+def cancel_on_stop(engine, query_id, cancel, interval, keep_alive=None):
+    """Watches the status of the query, and cancels it once it is stopped
+
+    The status is polled every ``interval`` seconds from a daemon thread,
+    which calls ``keep_alive`` along the way, until the returned function
+    is called.
+    """
+    done = threading.Event()
+
+    def watch():
+        while not done.wait(interval):
+            if keep_alive:
+                try:
+                    keep_alive()
+                except Exception as e:
+                    logging.exception(e)
+            try:
+                status = get_query_status(engine, query_id)
+            except Exception as e:
+                logging.exception(e)
+                continue
+            if status == QueryStatus.STOPPED:
+                logging.info("Cancelling query [{}]".format(query_id))
+                try:
+                    cancel()
+                except Exception as e:
+                    logging.exception(e)
+                return
+
+    thread = threading.Thread(target=watch)
+    thread.daemon = True
+    thread.start()
+
+    def stop_watching():
+        done.set()
+        thread.join()
+    return stop_watching
+
+
+def dumps_compressed(obj):
+    return zlib.compress(
+        json.dumps(obj, default=utils.json_iso_dttm_ser).encode('utf-8'))
+
+
+def loads_compressed(blob):
+    return json.loads(zlib.decompress(blob).decode('utf-8'))
+
+
+def order_key(value):
+    """Sort key of the values of a column, which may mix types
+
+    Numbers come first, then the other values grouped by type, None last.
+
+    >>> sorted([None, 'b', 2, 'a', 1.5], key=order_key)
+    [1.5, 2, 'a', 'b', None]
+    """
+    if value is None:
+        return (2, )
+    if isinstance(value, numbers.Number):
+        return (0, '', value)
+    return (1, type(value).__name__, value)
+
+
+class ResultsWriter(object):
+
+    """Stores query results in the results backend, by chunks of rows
+
+    The chunks are stored column by column under ``<key>_chunk_<index>``,
+    and the metadata of the results under the key itself, once all the
+    chunks are stored.
+    """
+
+    def __init__(self, key, chunk_size):
+        self.key = key
+        self.chunk_size = chunk_size
+        self.chunks = 0
+        self.failed = False
+
+    def set(self, key, obj):
+        if self.failed:
+            return
+        try:
+            results_backend.set(
+                key, dumps_compressed(obj),
+                timeout=app.config.get('RESULTS_BACKEND_TIMEOUT'))
+        except Exception as e:
+            logging.warning("Could not store the results in key=[{}]".format(
+                self.key))
+            logging.exception(e)
+            self.failed = True
+
+    def add_chunk(self, cdf):
+        self.set(
+            '{}_chunk_{}'.format(self.key, self.chunks), cdf.columnar_data)
+        self.chunks += 1
+
+    def close(self, meta):
+        """Stores the metadata, returns whether all went well"""
+        self.set(self.key, dict(
+            meta, chunk_size=self.chunk_size, chunks=self.chunks))
+        return not self.failed
+
+
+def get_results(key, offset=0, limit=None, columns=None, order_by=None,
+                ascending=True):
+    """Reads a window of the results stored by a ResultsWriter
+
+    :param columns: the names of the columns to project the results on
+    :param order_by: the name of the column to sort the results by, the
+        sort order is computed once and stored along with the results
+    :return: the payload of the results, None if they have expired
+    """
+    if offset < 0 or (limit is not None and limit < 0):
+        raise ValueError("The offset and limit can't be negative")
+    blob = results_backend.get(key)
+    if not blob:
+        return None
+    meta = loads_compressed(blob)
+    column_objs = meta['columns'] or []
+    if columns:
+        column_objs = [c for c in column_objs if c['name'] in columns]
+    names = [c['name'] for c in column_objs]
+    chunk_size = meta['chunk_size']
+    chunks = {}
+
+    def get_chunk(index):
+        if index not in chunks:
+            blob = results_backend.get('{}_chunk_{}'.format(key, index))
+            chunks[index] = loads_compressed(blob) if blob else None
+        return chunks[index]
+
+    rows = meta['rows']
+    end = rows if limit is None else min(rows, offset + limit)
+    if order_by:
+        if order_by not in [c['name'] for c in meta['columns'] or []]:
+            raise ValueError("Unknown column [{}]".format(order_by))
+        order_key = '{}_order_{}'.format(
+            key, hashlib.md5(order_by.encode('utf-8')).hexdigest())
+        blob = results_backend.get(order_key)
+        if blob:
+            order = loads_compressed(blob)
+        else:
+            values = []
+            for index in range(meta['chunks']):
+                chunk = get_chunk(index)
+                if chunk is None:
+                    return None
+                values += chunk[order_by]
+            try:
+                order = sorted(
+                    range(len(values)), key=lambda i: order_key(values[i]))
+            except TypeError:
+                raise ValueError(
+                    "The values of [{}] can't be ordered".format(order_by))
+            results_backend.set(
+                order_key, dumps_compressed(order),
+                timeout=app.config.get('RESULTS_BACKEND_TIMEOUT'))
+        if not ascending:
+            order.reverse()
+        indices = order[offset:end]
+    else:
+        indices = range(offset, end)
+
+    data = []
+    for i in indices:
+        chunk = get_chunk(i // chunk_size)
+        if chunk is None:
+            return None
+        data.append({name: chunk[name][i % chunk_size] for name in names})
+    return {
+        'query_id': meta['query_id'],
+        'status': meta['status'],
+        'columns': column_objs,
+        'data': data,
+        'offset': offset,
+        'rows': rows,
+        'query': meta['query'],
+    }
+
+
 @celery_app.task
-def get_sql_results(query_id, return_results=True):
-    """Executes the sql query returns the results."""
+def get_sql_results(query_id, return_results=True, store_results=False):
+    """Executes the sql query returns the results.
+
+    :param store_results: whether to store the results in the results
+        backend, under the ``results_key`` of the query
+    """
     session = db.session()
     session.commit()  # HACK
     query = session.query(models.Query).filter_by(id=query_id).one()
@@ -61,6 +277,17 @@ def get_sql_results(query_id, return_results=True):
         session.commit()
         raise Exception(query.error_message)
 
+    def handle_stopped():
+        """Local method ending the query once it was stopped by the user"""
+        query.status = QueryStatus.STOPPED
+        query.end_time = utils.now_as_float()
+        session.commit()
+        raise Exception("The query was stopped.")
+
+    if query.status == QueryStatus.STOPPED:
+        # stopped while waiting for a worker
+        handle_stopped()
+
     # Limit enforced only for retrieving the data, not for the CTA queries.
     is_select = is_query_select(executed_sql);
     if not is_select and not database.allow_dml:
@@ -83,75 +310,174 @@ def get_sql_results(query_id, return_results=True):
         executed_sql = database.wrap_sql_limit(executed_sql, query.limit)
         query.limit_used = True
     engine = database.get_sqla_engine(schema=query.schema)
-    try:
-        query.executed_sql = executed_sql
-        logging.info("Running query: \n{}".format(executed_sql))
-        result_proxy = engine.execute(query.executed_sql, schema=query.schema)
-    except Exception as e:
+    query.executed_sql = executed_sql
+
+    def handle_exception(e):
         logging.exception(e)
+        if get_query_status(db.engine, query_id) == QueryStatus.STOPPED:
+            handle_stopped()
         handle_error(utils.error_msg_from_exception(e))
 
-    cursor = result_proxy.cursor
-    query.status = QueryStatus.RUNNING
-    session.flush()
-    if database.backend == 'presto':
-        polled = cursor.poll()
-        # poll returns dict -- JSON status information or ``None``
-        # if the query is done
-        # https://github.com/dropbox/PyHive/blob/
-        # b34bdbf51378b3979eaf5eca9e956f06ddc36ca0/pyhive/presto.py#L178
-        while polled:
-            # Update the object and wait for the kill signal.
-            stats = polled.get('stats', {})
-            if stats:
-                completed_splits = float(stats.get('completedSplits'))
-                total_splits = float(stats.get('totalSplits'))
-                if total_splits and completed_splits:
-                    progress = 100 * (completed_splits / total_splits)
-                    if progress > query.progress:
-                        query.progress = progress
-                    session.commit()
-            time.sleep(1)
+    def set_status(status):
+        """Local method updating the status, unless the query was stopped
+
+        The status is updated in the database, so that a stop committed in
+        the meantime doesn't get overwritten.
+        """
+        table = models.Query.__table__
+        updated = session.execute(
+            table.update()
+            .where(table.c.id == query_id)
+            .where(table.c.status != QueryStatus.STOPPED)
+            .values(status=status)).rowcount
+        session.commit()
+        if not updated:
+            handle_stopped()
+
+    def on_wait():
+        """Local method flagging the query as queued, until it's stopped"""
+        if query.status != QueryStatus.QUEUED:
+            set_status(QueryStatus.QUEUED)
+        elif get_query_status(db.engine, query_id) == QueryStatus.STOPPED:
+            handle_stopped()
+
+    # waits for the database to run fewer queries than its limits
+    slots = database.query_slots(user_id=query.user_id, on_wait=on_wait)
+    try:
+        slots.acquire()
+    except Exception as e:
+        handle_exception(e)
+
+    try:
+        # committed, so that the query can be stopped while it runs
+        set_status(QueryStatus.RUNNING)
+        conn = engine.connect()
+        connection_id = database.get_connection_id(conn)
+    except Exception as e:
+        slots.release()
+        handle_exception(e)
+
+    # the cursor is only around once the query is submitted, the watching
+    # thread shouldn't touch the session's objects
+    running = {}
+
+    def cancel():
+        database.cancel_query(engine, running.get('cursor'), connection_id)
+
+    # the slots are held as long as the query runs, past their timeout
+    stop_watching = cancel_on_stop(
+        db.engine, query_id, cancel, app.config.get('SQL_STOP_POLL_INTERVAL'),
+        keep_alive=slots.refresh)
+    try:
+        logging.info("Running query: \n{}".format(executed_sql))
+        result_proxy = conn.execute(executed_sql, schema=query.schema)
+        cursor = running['cursor'] = result_proxy.cursor
+        if database.backend == 'presto':
             polled = cursor.poll()
+            # poll returns dict -- JSON status information or ``None``
+            # if the query is done
+            # https://github.com/dropbox/PyHive/blob/
+            # b34bdbf51378b3979eaf5eca9e956f06ddc36ca0/pyhive/presto.py#L178
+            while polled:
+                # Update the object and wait for the kill signal.
+                stats = polled.get('stats', {})
+                if stats:
+                    completed_splits = float(stats.get('completedSplits'))
+                    total_splits = float(stats.get('totalSplits'))
+                    if total_splits and completed_splits:
+                        progress = 100 * (completed_splits / total_splits)
+                        if progress > query.progress:
+                            query.progress = progress
+                        session.commit()
+                time.sleep(1)
+                polled = cursor.poll()
+
+        query.rows = result_proxy.rowcount
+        # The rows are fetched, serialized and stored by chunks, so that
+        # only a chunk of them is held in memory as objects
+        chunk_size = app.config.get('SQL_FETCH_CHUNK_SIZE')
+        writer = None
+        if store_results and results_backend:
+            writer = ResultsWriter('{}'.format(uuid.uuid4()), chunk_size)
+        data = []
+        columns = []
+        rows = 0
+        if result_proxy.cursor:
+            column_names = [col[0] for col in result_proxy.cursor.description]
+            columns = None
+            limit = (
+                query.limit if is_select and not query.select_as_cta
+                else None)
+            for chunk in fetch_chunks(result_proxy, chunk_size, limit):
+                cdf = dataframe.CaravelDataFrame(
+                    pd.DataFrame(chunk, columns=column_names))
+                if columns is None:
+                    columns = cdf.columns_dict
+                if writer:
+                    writer.add_chunk(cdf)
+                if return_results:
+                    # TODO consider generating tuples instead of dicts to
+                    # send less data through the wire. The command bellow
+                    # does that, but we'd need to align on the client side.
+                    # data = df.values.tolist()
+                    data.append(json.dumps(
+                        cdf.data, default=utils.json_iso_dttm_ser)[1:-1])
+                rows += cdf.size
+    except Exception as e:
+        # the query may still be running on the database, e.g. when the
+        # request timed out
+        try:
+            cancel()
+        except Exception as cancel_error:
+            logging.exception(cancel_error)
+        handle_exception(e)
+    finally:
+        # stops watching the query and hands the connection back to the pool
+        stop_watching()
+        conn.close()
+        slots.release()
+
+    if get_query_status(db.engine, query_id) == QueryStatus.STOPPED:
+        # a cancelled query may still end gracefully, with partial results
+        handle_stopped()
 
-    cdf = None
-    if result_proxy.cursor:
-        column_names = [col[0] for col in result_proxy.cursor.description]
-        data = result_proxy.fetchall()
-        cdf = dataframe.CaravelDataFrame(
-            pd.DataFrame(data, columns=column_names))
-    # TODO consider generating tuples instead of dicts to send
-    # less data through the wire. The command bellow does that,
-    # but we'd need to align on the client side.
-    # data = df.values.tolist()
-
-    query.rows = result_proxy.rowcount
     query.progress = 100
-    query.status = QueryStatus.SUCCESS
-    if query.rows == -1 and cdf:
+    if query.rows == -1:
         # Presto doesn't provide result_proxy.row_count
-        query.rows = cdf.size
+        query.rows = rows
     if query.select_as_cta:
         query.select_sql = '{}'.format(database.select_star(
             query.tmp_table_name, limit=query.limit))
     query.end_time = utils.now_as_float()
+
+    if writer:
+        # stored before the query is committed as done, so that its key is
+        # around when the client polls the query's status
+        logging.info("Storing results in key=[{}]".format(writer.key))
+        query.results_key = writer.key
+        meta = {
+            'query_id': query.id,
+            'status': QueryStatus.SUCCESS,
+            'columns': columns,
+            'rows': rows,
+            'query': dict(query.to_dict(), state=QueryStatus.SUCCESS),
+        }
+        if not writer.close(meta):
+            query.results_key = None
     session.commit()
+    # flagged as done last, unless it was stopped in the meantime
+    set_status(QueryStatus.SUCCESS)
 
     if return_results:
         payload = {
             'query_id': query.id,
             'status': query.status,
-            'data': [],
         }
         if query.status == models.QueryStatus.SUCCESS:
-            payload['data'] = cdf.data if cdf else []
-            payload['columns'] = cdf.columns_dict if cdf else []
+            payload['columns'] = columns
         else:
             payload['error'] = query.error_message
-        return payload
-    '''
-    # Hack testing using a kv store for results
-    key = "query_id={}".format(query.id)
-    logging.info("Storing results in key=[{}]".format(key))
-    cache.set(key, json.dumps(payload, default=utils.json_iso_dttm_ser))
-    '''
+            data = []
+        # the serialized payload, with the serialized chunks spliced in
+        payload = json.dumps(payload, default=utils.json_iso_dttm_ser)
+        return payload[:-1] + ', "data": [' + ', '.join(data) + ']}'
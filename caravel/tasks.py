@@ -0,0 +1,168 @@
+"""Background tasks run by the celery workers"""
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+from __future__ import unicode_literals
+
+from datetime import datetime, timedelta
+import json
+import logging
+import time
+
+from flask import g
+from flask_login import login_user
+from sqlalchemy import desc, func
+from werkzeug.datastructures import ImmutableMultiDict
+
+from caravel import app, cache, db, models, sm, utils, viz
+from caravel.source_registry import SourceRegistry
+from caravel.sql_lab import celery_app
+
+config = app.config
+
+
+def login_worker(slc=None):
+    """Logs in the user the visualizations are computed as
+
+    CACHE_WORKER_USER when set, the creator or an owner of the slice
+    otherwise, so that the access checks of the visualizations see the
+    same user as in the web requests.
+    """
+    username = config.get('CACHE_WORKER_USER')
+    if username:
+        user = sm.find_user(username=username)
+    elif slc:
+        user = slc.created_by or next(iter(slc.owners), None)
+    else:
+        user = None
+    g.user = user
+    if user:
+        login_user(user)
+
+
+@celery_app.task
+def refresh_payload(datasource_type, datasource_id, form_data,
+                    lock_key=None, lock_token=None):
+    """Recomputes and caches the payload of a visualization.
+
+    :param form_data: the form data the visualization was built from,
+        as a dict of lists
+    :param lock_key: key of the lock taken while the refresh was scheduled,
+        released once the payload is cached
+    """
+    form_data = ImmutableMultiDict(form_data)
+    session = db.session()
+    try:
+        with app.test_request_context():
+            g.low_priority = True
+            datasource = (
+                session.query(SourceRegistry.sources[datasource_type])
+                .filter_by(id=datasource_id)
+                .first()
+            )
+            slc = None
+            slice_id = form_data.get('slice_id')
+            if slice_id:
+                slc = session.query(models.Slice).filter_by(id=slice_id).first()
+            login_worker(slc)
+            viz_obj = viz.viz_types[form_data.get('viz_type')](
+                datasource, form_data=form_data, slice_=slc)
+            viz_obj.get_json(force=True)
+    except Exception as e:
+        logging.exception(e)
+    finally:
+        if lock_key:
+            utils.CacheLock(cache, lock_key, token=lock_token).release()
+        session.close()
+
+
+def get_popular_dashboards(session, limit, days):
+    """Returns the ids of the most viewed dashboards over the last days"""
+    qry = (
+        session.query(models.Log.dashboard_id)
+        .filter(models.Log.action == 'dashboard')
+        .filter(models.Log.dttm >= datetime.now() - timedelta(days=days))
+        .group_by(models.Log.dashboard_id)
+        .order_by(desc(func.count(models.Log.id)))
+        .limit(limit)
+    )
+    return [dashboard_id for dashboard_id, in qry.all()]
+
+
+def warm_up_slice(slice_id, query_results=None):
+    """Refreshes the cached payload of a slice, returns how it went"""
+    start = time.time()
+    error = None
+    with app.test_request_context():
+        g.query_results = query_results or utils.SharedResults()
+        g.low_priority = True
+        try:
+            slc = db.session.query(models.Slice).filter_by(id=slice_id).one()
+            login_worker(slc)
+            slc.get_viz().get_json(force=True)
+        except Exception as e:
+            logging.exception(e)
+            error = utils.error_msg_from_exception(e)
+    return {
+        'slice_id': slice_id,
+        'success': error is None,
+        'error': error,
+        'duration': round(time.time() - start, 3),
+    }
+
+
+def warm_up_dashboards(limit=None, days=None):
+    """Warms up the cache of the slices of the most viewed dashboards
+
+    Slices are refreshed concurrently, with at most
+    CACHE_WARMUP_WORKERS_PER_DATABASE slices querying the same database at
+    once. The outcome of each slice is logged under the `warm_up_cache`
+    action, and returned.
+    """
+    session = db.session()
+    dashboard_ids = get_popular_dashboards(
+        session,
+        limit or config.get('CACHE_WARMUP_TOP_DASHBOARDS'),
+        days or config.get('CACHE_WARMUP_DAYS'))
+    dashboards = (
+        session.query(models.Dashboard)
+        .filter(models.Dashboard.id.in_(dashboard_ids))
+        .all()
+    ) if dashboard_ids else []
+
+    slice_dashboards = {}
+    databases = {}
+    for dash in dashboards:
+        for slc in dash.slices:
+            if slc.id in slice_dashboards or not slc.datasource:
+                continue
+            slice_dashboards[slc.id] = dash.id
+            databases[slc.id] = (
+                slc.datasource.type, slc.datasource.database.id)
+
+    query_results = utils.SharedResults()
+    results = list(utils.parallel_imap(
+        lambda slice_id: warm_up_slice(slice_id, query_results),
+        list(databases),
+        key=databases.get,
+        workers=config.get('CACHE_WARMUP_WORKERS'),
+        workers_per_key=config.get('CACHE_WARMUP_WORKERS_PER_DATABASE')))
+
+    for result in results:
+        session.add(models.Log(
+            action='warm_up_cache',
+            dashboard_id=slice_dashboards[result['slice_id']],
+            slice_id=result['slice_id'],
+            json=json.dumps(result)))
+    session.commit()
+    return results
+
+
+@celery_app.task
+def warm_up_cache():
+    """Periodic task warming up the cache of the most viewed dashboards"""
+    results = warm_up_dashboards()
+    failures = [r for r in results if not r['success']]
+    logging.info("Warmed up {} slices, {} failed".format(
+        len(results), len(failures)))
+    return results
@@ -5,14 +5,21 @@ from __future__ import print_function
 from __future__ import unicode_literals
 
 from builtins import object
-from datetime import date, datetime
+import codecs
+from collections import OrderedDict
+from datetime import date, datetime, timedelta
 import decimal
 import functools
 import json
 import logging
+from multiprocessing.pool import ThreadPool
 import numpy
 import signal
+import struct
+import threading
+import time
 import uuid
+import zlib
 
 import parsedatetime
 import sqlalchemy as sa
@@ -96,6 +103,405 @@ class memoized(object):  # noqa
         return functools.partial(self.__call__, obj)
 
 
+class CacheLock(object):
+
+    """A lock shared across processes through the cache backend
+
+    Relies on ``cache.add`` being atomic, which is the case for the Redis
+    and Memcached backends. The lock expires after ``timeout`` seconds so
+    that a dead holder can't block the others forever.
+
+    Flask-Cache's ``add`` doesn't return the outcome of the backend's, so
+    the werkzeug cache behind it is called directly.
+    """
+
+    def __init__(self, cache, key, timeout=None, token=None):
+        self.cache = cache
+        self.key = key
+        self.timeout = timeout
+        self.token = token or uuid.uuid4().hex
+
+    def acquire(self):
+        backend = getattr(self.cache, 'cache', self.cache)
+        return bool(backend.add(self.key, self.token, timeout=self.timeout))
+
+    def locked(self):
+        return self.cache.get(self.key) is not None
+
+    def release(self):
+        if self.cache.get(self.key) == self.token:
+            self.cache.delete(self.key)
+
+    def refresh(self):
+        """Extends the lock for another ``timeout`` seconds, if still held"""
+        if self.cache.get(self.key) == self.token:
+            self.cache.set(self.key, self.token, timeout=self.timeout)
+
+
+class CacheSemaphore(object):
+
+    """A semaphore shared across processes through the cache backend
+
+    Each of its ``slots`` is a CacheLock, expiring after ``timeout``
+    seconds. Low priority holders can't take the first ``reserved`` slots,
+    which are left to the interactive requests.
+    """
+
+    def __init__(self, cache, key, slots, timeout=None, reserved=0):
+        self.cache = cache
+        self.key = key
+        self.slots = slots
+        self.timeout = timeout
+        self.reserved = min(reserved, slots - 1)
+        self.lock = None
+
+    def acquire(self, low_priority=False):
+        """Takes one of the free slots, returns whether there was one"""
+        for i in range(self.reserved if low_priority else 0, self.slots):
+            lock = CacheLock(
+                self.cache, '{}__slot_{}'.format(self.key, i),
+                timeout=self.timeout)
+            if lock.acquire():
+                self.lock = lock
+                return True
+        return False
+
+    def release(self):
+        if self.lock:
+            self.lock.release()
+            self.lock = None
+
+    def refresh(self):
+        if self.lock:
+            self.lock.refresh()
+
+
+class SemaphoreSlots(object):
+
+    """Holds a slot of each of the semaphores, to be used in a ``with`` block
+
+    Waits for the slots to free up, polling them every ``interval`` seconds
+    and calling ``on_wait`` before each wait. Slots are only held once all
+    of them are, so that the waiting callers don't hold on to any. Raises
+    if the slots couldn't be taken within ``timeout`` seconds.
+    """
+
+    def __init__(self, semaphores, low_priority=False, timeout=None,
+                 on_wait=None, interval=0.5):
+        self.semaphores = semaphores
+        self.low_priority = low_priority
+        self.timeout = timeout
+        self.on_wait = on_wait
+        self.interval = interval
+
+    def acquire(self):
+        start = time.time()
+        while True:
+            held = []
+            for semaphore in self.semaphores:
+                if not semaphore.acquire(low_priority=self.low_priority):
+                    break
+                held.append(semaphore)
+            else:
+                return
+            for semaphore in held:
+                semaphore.release()
+            if self.timeout is not None and (
+                    time.time() - start >= self.timeout):
+                raise CaravelException(
+                    "Too many queries are running against the database, "
+                    "try again later")
+            if self.on_wait:
+                self.on_wait()
+            time.sleep(self.interval)
+
+    def release(self):
+        for semaphore in self.semaphores:
+            semaphore.release()
+
+    def refresh(self):
+        """Keeps the slots held past their timeout"""
+        for semaphore in self.semaphores:
+            semaphore.refresh()
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.release()
+
+
+class LRUCache(object):
+
+    """In-process cache bounded by the total size of its values
+
+    Values are usually strings, their size defaults to their length. The
+    least recently used entries are evicted once ``max_size`` is reached,
+    and entries set with a timeout are dropped once it's elapsed.
+    """
+
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self.size = 0
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.pop(key, None)
+            if entry is None:
+                return None
+            expires, size, value = entry
+            if expires is not None and expires < time.time():
+                self.size -= size
+                return None
+            # reinserting marks the entry as the most recently used
+            self.entries[key] = entry
+            return value
+
+    def set(self, key, value, timeout=None, size=None):
+        size = len(value) if size is None else size
+        if size > self.max_size:
+            self.delete(key)
+            return False
+        expires = time.time() + timeout if timeout else None
+        with self.lock:
+            self._pop(key)
+            while self.entries and self.size + size > self.max_size:
+                self._pop(next(iter(self.entries)))
+            self.entries[key] = (expires, size, value)
+            self.size += size
+        return True
+
+    def delete(self, key):
+        with self.lock:
+            self._pop(key)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.size = 0
+
+    def _pop(self, key):
+        entry = self.entries.pop(key, None)
+        if entry is not None:
+            self.size -= entry[1]
+
+
+class SharedResults(object):
+
+    """Computes values once per key, and shares them across threads
+
+    Callers asking for a key that is being computed wait for its value.
+    Failed computations aren't kept, the next caller tries again.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.key_locks = {}
+        self.results = {}
+
+    def get(self, key, func):
+        with self.lock:
+            key_lock = self.key_locks.setdefault(key, threading.Lock())
+        with key_lock:
+            if key not in self.results:
+                self.results[key] = func()
+            return self.results[key]
+
+
+GZIP_HEADER = b'\x1f\x8b\x08\x00\x00\x00\x00\x00\x00\xff'
+
+
+def sync_deflate(data):
+    """Compresses bytes into a raw deflate stream that can be continued
+
+    The stream is sync flushed, it ends on a byte boundary and more deflate
+    blocks can be appended to it. Returns the compressed data along with
+    the crc32 and the length of the uncompressed data, as needed by
+    ``gzip_concat``.
+    """
+    compressor = zlib.compressobj(
+        zlib.Z_DEFAULT_COMPRESSION, zlib.DEFLATED, -zlib.MAX_WBITS)
+    deflated = compressor.compress(data) + compressor.flush(zlib.Z_SYNC_FLUSH)
+    return deflated, zlib.crc32(data) & 0xffffffff, len(data)
+
+
+def inflate(deflated):
+    """Decompresses a raw deflate stream"""
+    return zlib.decompressobj(-zlib.MAX_WBITS).decompress(deflated)
+
+
+def gzip_concat(deflated, crc, size, tail=b''):
+    """Returns a gzip stream of the sync_deflate'd data followed by tail
+
+    Only the tail gets compressed, the compressed data is used as is.
+
+    >>> import gzip, io
+    >>> deflated, crc, size = sync_deflate(b'{"a": 1')
+    >>> data = gzip_concat(deflated, crc, size, b', "b": 2}')
+    >>> gzip.GzipFile(fileobj=io.BytesIO(data)).read() == b'{"a": 1, "b": 2}'
+    True
+    """
+    compressor = zlib.compressobj(
+        zlib.Z_DEFAULT_COMPRESSION, zlib.DEFLATED, -zlib.MAX_WBITS)
+    return b''.join([
+        GZIP_HEADER,
+        deflated,
+        compressor.compress(tail) + compressor.flush(),
+        struct.pack(
+            '<II',
+            zlib.crc32(tail, crc) & 0xffffffff,
+            (size + len(tail)) & 0xffffffff),
+    ])
+
+
+def parallel_imap(func, items, key=None, workers=8, workers_per_key=None):
+    """Maps ``func`` over ``items`` in a thread pool
+
+    Results are yielded as soon as they are ready, in no particular order.
+    When ``key`` is given, at most ``workers_per_key`` of the items sharing
+    the same ``key(item)`` are processed at once.
+
+    >>> sorted(parallel_imap(lambda x: x * 2, [1, 2, 3]))
+    [2, 4, 6]
+    """
+    items = list(items)
+    if not items:
+        return
+    semaphores = {}
+    if key and workers_per_key:
+        semaphores = {
+            key(item): threading.BoundedSemaphore(workers_per_key)
+            for item in items}
+
+    def run(item):
+        semaphore = semaphores.get(key(item)) if semaphores else None
+        if semaphore is None:
+            return func(item)
+        with semaphore:
+            return func(item)
+
+    pool = ThreadPool(min(workers, len(items)))
+    try:
+        for result in pool.imap_unordered(run, items):
+            yield result
+    finally:
+        pool.terminate()
+
+
+class JSONObjectStream(object):
+
+    """Parses a json object incrementally, out of chunks of bytes
+
+    Iterating over it yields the ``(key, value)`` members of the object as
+    they get parsed. The items of the ``stream_key`` array are yielded one
+    by one, as ``(stream_key, item)``, so that a large array never has to be
+    held in memory at once. ``streaming`` is True while they are.
+
+    >>> chunks = [b'{"type": "gro', b'upby", "result": [1', b'2, 3', b'4]}']
+    >>> stream = JSONObjectStream(chunks, 'result')
+    >>> [value for key, value in stream if key == 'result']
+    [12, 34]
+    """
+
+    whitespace = ' \t\n\r'
+
+    def __init__(self, chunks, stream_key=None):
+        self.chunks = iter(chunks)
+        self.stream_key = stream_key
+        self.decoder = json.JSONDecoder()
+        self.text_decoder = codecs.getincrementaldecoder('utf-8')()
+        self.buf = ''
+        self.pos = 0
+        self.eof = False
+        self.streaming = False
+
+    def fill(self, size=1):
+        """Reads chunks until ``size`` more characters are buffered
+
+        Returns False once the chunks are exhausted.
+        """
+        if self.eof:
+            return False
+        parts = [self.buf[self.pos:]]
+        read = 0
+        while read < size:
+            try:
+                chunk = next(self.chunks)
+            except StopIteration:
+                self.eof = True
+                break
+            text = self.text_decoder.decode(chunk)
+            parts.append(text)
+            read += len(text)
+        self.buf = ''.join(parts)
+        self.pos = 0
+        return read > 0
+
+    def peek(self):
+        """Returns the next non whitespace character"""
+        while True:
+            while (
+                    self.pos < len(self.buf) and
+                    self.buf[self.pos] in self.whitespace):
+                self.pos += 1
+            if self.pos < len(self.buf):
+                return self.buf[self.pos]
+            if not self.fill():
+                raise ValueError("Unexpected end of json")
+
+    def expect(self, chars):
+        c = self.peek()
+        if c not in chars:
+            raise ValueError("Expected one of {} at {}, got {}".format(
+                chars, self.pos, c))
+        self.pos += 1
+        return c
+
+    def decode(self):
+        """Decodes the next json value, reading as many chunks as needed"""
+        self.peek()
+        while True:
+            try:
+                value, end = self.decoder.raw_decode(self.buf, self.pos)
+                # a number at the end of the buffer may go on in the next chunk
+                if end < len(self.buf) or self.eof:
+                    self.pos = end
+                    return value
+            except ValueError:
+                if self.eof:
+                    raise
+            # the value goes on in the next chunks, the buffer doubles before
+            # it's decoded again so that a large value is only decoded a few
+            # times over
+            self.fill(len(self.buf) - self.pos)
+
+    def __iter__(self):
+        self.expect('{')
+        if self.peek() == '}':
+            return
+        while True:
+            key = self.decode()
+            self.expect(':')
+            if key == self.stream_key and self.peek() == '[':
+                self.pos += 1
+                if self.peek() == ']':
+                    self.pos += 1
+                else:
+                    self.streaming = True
+                    while True:
+                        yield key, self.decode()
+                        if self.expect(',]') == ']':
+                            break
+                    self.streaming = False
+            else:
+                yield key, self.decode()
+            if self.expect(',}') == '}':
+                return
+
+
 def get_or_create_main_db(caravel):
     db = caravel.db
     config = caravel.app.config
@@ -113,6 +519,27 @@ def get_or_create_main_db(caravel):
     return dbobj
 
 
+def ping_connection(dbapi_con, con_record, con_proxy):
+    """Pool ``checkout`` listener making sure the connection is live
+
+    Raising ``DisconnectionError`` makes the pool discard the connection
+    and retry the checkout with a fresh one.
+    """
+    try:
+        if hasattr(dbapi_con, 'ping'):
+            try:
+                dbapi_con.ping(False)
+            except TypeError:
+                dbapi_con.ping()
+        else:
+            cursor = dbapi_con.cursor()
+            cursor.execute("SELECT 1")
+            cursor.close()
+    except Exception as e:
+        logging.warning("Discarding dead connection: {}".format(e))
+        raise sa.exc.DisconnectionError()
+
+
 class DimSelector(Having):
     def __init__(self, **args):
         # Just a hack to prevent any exceptions
@@ -193,6 +620,25 @@ def parse_human_timedelta(s):
     return d - dttm
 
 
+def snap_datetime(dttm, seconds, ceil=False):
+    """Rounds a datetime down, or up, to a multiple of seconds since the epoch
+
+    >>> snap_datetime(datetime(2016, 7, 4, 13, 37, 10), 3600)
+    datetime.datetime(2016, 7, 4, 13, 0)
+    >>> snap_datetime(datetime(2016, 7, 4, 13, 37, 10), 3600, ceil=True)
+    datetime.datetime(2016, 7, 4, 14, 0)
+    >>> snap_datetime(datetime(2016, 7, 4), 86400, ceil=True)
+    datetime.datetime(2016, 7, 4, 0, 0)
+    """
+    offset = (dttm.replace(tzinfo=None) - EPOCH).total_seconds() % seconds
+    if not offset:
+        return dttm
+    dttm -= timedelta(seconds=offset)
+    if ceil:
+        dttm += timedelta(seconds=seconds)
+    return dttm
+
+
 class JSONEncodedDict(TypeDecorator):
 
     """Represents an immutable structure as a json-encoded string."""
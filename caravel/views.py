@@ -15,7 +15,8 @@ import functools
 import sqlalchemy as sqla
 
 from flask import (
-    g, request, redirect, flash, Response, render_template, Markup)
+    g, request, redirect, flash, Response, render_template, Markup,
+    stream_with_context, _request_ctx_stack)
 from flask_appbuilder import ModelView, CompactCRUDMixin, BaseView, expose
 from flask_appbuilder.actions import action
 from flask_appbuilder.models.sqla.interface import SQLAInterface
@@ -33,7 +34,7 @@ from wtforms.validators import ValidationError
 import caravel
 from caravel import (
     appbuilder, cache, db, models, viz, utils, app,
-    sm, ascii_art, sql_lab
+    sm, ascii_art, sql_lab, results_backend
 )
 from caravel import bl_models
 from caravel.source_registry import SourceRegistry
@@ -82,6 +83,23 @@ def get_database_access_error_msg(database_name):
               "`all_datasource_access` permission", name=database_name)
 
 
+def viz_json_response(viz_obj):
+    """Serves the viz json payload, as gzip if the client accepts it"""
+    if 'gzip' in request.accept_encodings:
+        resp = Response(
+            viz_obj.get_json(compress=True),
+            status=200,
+            mimetype="application/json")
+        resp.headers['Content-Encoding'] = 'gzip'
+    else:
+        resp = Response(
+            viz_obj.get_json(),
+            status=200,
+            mimetype="application/json")
+    resp.vary.add('Accept-Encoding')
+    return resp
+
+
 def get_datasource_access_error_msg(datasource_name):
     return __("This endpoint requires the datasource %(name)s, database or "
               "`all_datasource_access` permission", name=datasource_name)
@@ -503,7 +521,9 @@ class DatabaseView(CaravelModelView, DeleteMixin):  # noqa
             "sqlalchemy.create_engine) call, while the ``metadata_params`` "
             "gets unpacked into the [sqlalchemy.MetaData]"
             "(http://docs.sqlalchemy.org/en/rel_1_0/core/metadata.html"
-            "#sqlalchemy.schema.MetaData) call. ", True),
+            "#sqlalchemy.schema.MetaData) call. The ``concurrency_limit`` "
+            "caps the number of queries running at once against the "
+            "database. ", True),
     }
     label_columns = {
         'expose_in_sqllab': _("Expose in SQL Lab"),
@@ -563,7 +583,8 @@ class TableModelView(CaravelModelView, DeleteMixin):  # noqa
     edit_columns = [
         'table_name', 'sql', 'is_featured', 'database', 'schema',
         'description', 'owner',
-        'main_dttm_col', 'default_endpoint', 'offset', 'cache_timeout']
+        'main_dttm_col', 'default_endpoint', 'offset', 'cache_timeout',
+        'serve_stale']
     related_views = [TableColumnInlineView, SqlMetricInlineView]
     base_order = ('changed_on', 'desc')
     description_columns = {
@@ -580,6 +601,9 @@ class TableModelView(CaravelModelView, DeleteMixin):  # noqa
             "This fields acts a Caravel view, meaning that Caravel will "
             "run a query against this string as a subquery."
         ),
+        'serve_stale': _(
+            "Serve expired cached data right away while it gets refreshed "
+            "in the background"),
     }
     base_filters = [['id', TableSlice, lambda: []]]
     label_columns = {
@@ -592,6 +616,7 @@ class TableModelView(CaravelModelView, DeleteMixin):  # noqa
         'default_endpoint': _("Default Endpoint"),
         'offset': _("Offset"),
         'cache_timeout': _("Cache Timeout"),
+        'serve_stale': _("Serve Stale"),
     }
 
     def pre_add(self, table):
@@ -700,7 +725,8 @@ class SliceModelView(CaravelModelView, DeleteMixin):  # noqa
     list_columns = [
         'slice_link', 'viz_type', 'datasource_link', 'creator', 'modified']
     edit_columns = [
-        'slice_name', 'description', 'viz_type', 'owners', 'dashboards', 'params', 'cache_timeout']
+        'slice_name', 'description', 'viz_type', 'owners', 'dashboards', 'params', 'cache_timeout',
+        'serve_stale']
     base_order = ('changed_on', 'desc')
     description_columns = {
         'description': Markup(
@@ -716,6 +742,9 @@ class SliceModelView(CaravelModelView, DeleteMixin):  # noqa
         'cache_timeout': _(
             "Duration (in seconds) of the caching timeout for this slice."
         ),
+        'serve_stale': _(
+            "Serve expired cached data right away while it gets refreshed "
+            "in the background, overrides the datasource setting"),
     }
     base_filters = [['id', FilterSlice, lambda: []]]
     label_columns = {
@@ -727,6 +756,7 @@ class SliceModelView(CaravelModelView, DeleteMixin):  # noqa
         'modified': _("Last Modified"),
         'owners': _("Owners"),
         'params': _("Parameters"),
+        'serve_stale': _("Serve Stale"),
         'slice_link': _("Slice"),
         'slice_name': _("Name"),
         'table': _("Table"),
@@ -909,7 +939,7 @@ class DruidDatasourceModelView(CaravelModelView, DeleteMixin):  # noqa
     edit_columns = [
         'datasource_name', 'cluster', 'description', 'owner',
         'is_featured', 'is_hidden', 'default_endpoint', 'offset',
-        'cache_timeout']
+        'cache_timeout', 'serve_stale']
     add_columns = edit_columns
     page_size = 500
     base_order = ('datasource_name', 'asc')
@@ -930,6 +960,7 @@ class DruidDatasourceModelView(CaravelModelView, DeleteMixin):  # noqa
         'default_endpoint': _("Default Endpoint"),
         'offset': _("Time Offset"),
         'cache_timeout': _("Cache Timeout"),
+        'serve_stale': _("Serve Stale"),
     }
 
     def post_add(self, datasource):
@@ -1171,15 +1202,9 @@ class Caravel(BaseCaravelView):
         if slice_params_multi_dict.get("json") == "true":
             if config.get("DEBUG"):
                 # Allows for nice debugger stack traces in debug mode
-                return Response(
-                    viz_obj.get_json(),
-                    status=200,
-                    mimetype="application/json")
+                return viz_json_response(viz_obj)
             try:
-                return Response(
-                    viz_obj.get_json(),
-                    status=200,
-                    mimetype="application/json")
+                return viz_json_response(viz_obj)
             except Exception as e:
                 logging.exception(e)
                 return json_error_response(utils.error_msg_from_exception(e))
@@ -1269,15 +1294,9 @@ class Caravel(BaseCaravelView):
         if slice_params_multi_dict.get("json") == "true":
             if config.get("DEBUG"):
                 # Allows for nice debugger stack traces in debug mode
-                return Response(
-                    viz_obj.get_json(),
-                    status=200,
-                    mimetype="application/json")
+                return viz_json_response(viz_obj)
             try:
-                return Response(
-                    viz_obj.get_json(),
-                    status=200,
-                    mimetype="application/json")
+                return viz_json_response(viz_obj)
             except Exception as e:
                 logging.exception(e)
                 return json_error_response(utils.error_msg_from_exception(e))
@@ -1649,6 +1668,84 @@ class Caravel(BaseCaravelView):
             dash_save_perm=dash_save_perm,
             dash_edit_perm=dash_edit_perm)
 
+    @has_access
+    @expose("/dashboard/<dashboard_id>/data")
+    def dashboard_data(self, dashboard_id):
+        """Streams the json payloads of all the slices of a dashboard
+
+        The slices are computed concurrently, with at most
+        DASHBOARD_DATA_WORKERS_PER_DATABASE slices per database. Each line of
+        the response is a json object holding a `slice_id` and either the
+        `payload` of the slice or an `error`, in the order slices complete.
+        """
+        session = db.session()
+        qry = session.query(models.Dashboard)
+        if dashboard_id.isdigit():
+            qry = qry.filter_by(id=int(dashboard_id))
+        else:
+            qry = qry.filter_by(slug=dashboard_id)
+        dash = qry.one()
+        datasources = {slc.datasource for slc in dash.slices}
+        for datasource in datasources - {None}:
+            if not self.datasource_access(datasource):
+                return json_error_response(
+                    get_datasource_access_error_msg(datasource.name),
+                    status=403)
+
+        user = g.user
+        # identical queries of the slices are run only once
+        query_results = utils.SharedResults()
+
+        def get_database_key(slc):
+            """The database queried by the slice, None if it can't be told
+
+            The slices missing their datasource or database report their
+            error on their own line.
+            """
+            try:
+                return (slc.datasource.type, slc.datasource.database.id)
+            except Exception:
+                return None
+
+        databases = {slc.id: get_database_key(slc) for slc in dash.slices}
+
+        def get_slice_json(item):
+            slice_id, ctx = item
+            # each thread works with its own request context and db session
+            with ctx:
+                g.user = user
+                g.query_results = query_results
+                try:
+                    slc = (
+                        db.session.query(models.Slice)
+                        .filter_by(id=slice_id)
+                        .one()
+                    )
+                    return '{{"slice_id": {}, "payload": {}}}\n'.format(
+                        slice_id, slc.get_viz().get_json())
+                except Exception as e:
+                    logging.exception(e)
+                    return json.dumps({
+                        'slice_id': slice_id,
+                        'error': utils.error_msg_from_exception(e),
+                    }) + '\n'
+
+        def generate():
+            items = [
+                (slice_id, _request_ctx_stack.top.copy())
+                for slice_id in databases]
+            for line in utils.parallel_imap(
+                    get_slice_json, items,
+                    key=lambda item: databases[item[0]],
+                    workers=config.get('DASHBOARD_DATA_WORKERS'),
+                    workers_per_key=config.get(
+                        'DASHBOARD_DATA_WORKERS_PER_DATABASE')):
+                yield line
+
+        return Response(
+            stream_with_context(generate()),
+            mimetype="application/x-ndjson")
+
     @has_access
     @expose("/sync_druid/", methods=['POST'])
     @log_this
@@ -1884,7 +1981,9 @@ class Caravel(BaseCaravelView):
         # Async request.
         if async:
             # Ignore the celery future object and the request may time out.
-            sql_lab.get_sql_results.delay(query_id, return_results=False)
+            sql_lab.get_sql_results.delay(
+                query_id, return_results=False,
+                store_results=bool(results_backend))
             return Response(
                 json.dumps({'query': query.to_dict()},
                            default=utils.json_int_dttm_ser,
@@ -1905,13 +2004,104 @@ class Caravel(BaseCaravelView):
                 data = sql_lab.get_sql_results(query_id, return_results=True)
         except Exception as e:
             logging.exception(e)
+            if (
+                    sql_lab.get_query_status(db.engine, query_id) ==
+                    QueryStatus.STOPPED):
+                # not an error, the client already shows the query as stopped
+                return Response(
+                    json.dumps({
+                        'query_id': query_id,
+                        'status': QueryStatus.STOPPED,
+                        'data': [],
+                        'query': query.to_dict(),
+                    }, default=utils.json_iso_dttm_ser),
+                    status=200,
+                    mimetype="application/json")
             return Response(
                 json.dumps({'error': "{}".format(e)}),
                 status=500,
                 mimetype="application/json")
-        data['query'] = query.to_dict()
+        # the results come serialized, the query gets spliced in
+        data = data[:-1] + ', "query": ' + json.dumps(
+            query.to_dict(), default=utils.json_iso_dttm_ser) + '}'
+        return Response(
+            data,
+            status=200,
+            mimetype="application/json")
+
+    @has_access_api
+    @expose("/stop_query/", methods=['POST'])
+    @log_this
+    def stop_query(self):
+        """Flags a query as stopped, the worker running it then cancels it"""
+        client_id = request.form.get('client_id')
+        session = db.session()
+        query = (
+            session.query(models.Query)
+            .filter_by(client_id=client_id)
+            .first()
+        )
+        if not query:
+            return json_error_response(
+                "The query could not be found.", status=404)
+        if not self.database_access(query.database):
+            return json_error_response(
+                get_database_access_error_msg(query.database.database_name),
+                status=403)
+        if query.status in (
+                QueryStatus.PENDING, QueryStatus.SCHEDULED,
+                QueryStatus.QUEUED, QueryStatus.RUNNING):
+            query.status = QueryStatus.STOPPED
+            session.commit()
+        return Response(
+            json.dumps({'query': query.to_dict()},
+                       default=utils.json_int_dttm_ser),
+            status=200,
+            mimetype="application/json")
+
+    @has_access_api
+    @expose("/results/<key>/")
+    @log_this
+    def results(self, key):
+        """Serves the results of an async query off the results backend
+
+        A window of the results can be requested with the offset and limit
+        params, projected on a comma separated list of columns, and sorted
+        on one of them with order_by and desc.
+        """
+        if not results_backend:
+            return json_error_response("Results backend isn't configured.")
+        query = (
+            db.session.query(models.Query)
+            .filter_by(results_key=key)
+            .first()
+        )
+        if not query:
+            return json_error_response(
+                "The query results could not be found.", status=404)
+        if not self.database_access(query.database):
+            return json_error_response(
+                get_database_access_error_msg(query.database.database_name),
+                status=403)
+        columns = request.args.get('columns')
+        try:
+            limit = request.args.get('limit')
+            payload = sql_lab.get_results(
+                key,
+                offset=int(request.args.get('offset', 0)),
+                limit=int(limit) if limit else None,
+                columns=columns.split(',') if columns else None,
+                order_by=request.args.get('order_by'),
+                ascending=request.args.get('desc') != 'true')
+        except ValueError as e:
+            return json_error_response(
+                utils.error_msg_from_exception(e), status=400)
+        if not payload:
+            return json_error_response(
+                "The query results have expired, run the query again.",
+                status=410)
         return Response(
-            json.dumps(data, default=utils.json_iso_dttm_ser),
+            json.dumps(payload, default=utils.json_iso_dttm_ser),
             status=200,
             mimetype="application/json")
 
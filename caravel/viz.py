@@ -11,19 +11,20 @@ from __future__ import unicode_literals
 import copy
 import hashlib
 import logging
+import time
 import uuid
-import zlib
 
 from collections import OrderedDict, defaultdict
 from datetime import datetime, timedelta
 
 import pandas as pd
 import numpy as np
-from flask import request
+from flask import g, has_app_context, request
 from flask_babel import lazy_gettext as _
 from markdown import markdown
 import simplejson as json
-from six import string_types, PY3
+from six import string_types
+from werkzeug.contrib.cache import NullCache
 from werkzeug.datastructures import ImmutableMultiDict, MultiDict
 from werkzeug.urls import Href
 from dateutil import relativedelta as rdelta
@@ -34,6 +35,27 @@ from caravel.utils import flasher
 
 config = app.config
 
+# First tier of the payload cache, in front of the CACHE_CONFIG backend
+local_cache = utils.LRUCache(config.get('CACHE_LOCAL_MAX_SIZE'))
+
+# Time grains whose buckets have a fixed duration and are aligned on the epoch
+FIXED_TIME_GRAINS = {
+    'second': timedelta(seconds=1),
+    'minute': timedelta(minutes=1),
+    'hour': timedelta(hours=1),
+    'day': timedelta(days=1),
+}
+# Queries spanning more buckets than this are not segmented
+SEGMENT_MAX_BUCKETS = 1000
+
+# Form fields that are either resolved in the query object or that don't
+# shape the data of the payload, left out of the cache key
+CACHE_KEY_EXCLUDED_FIELDS = (
+    'action', 'async', 'collapsed_fieldsets', 'csv', 'extra_filters',
+    'force', 'json', 'previous_viz_type', 'since', 'slice_id', 'slice_name',
+    'standalone', 'token', 'until', 'userid',
+)
+
 
 class BaseViz(object):
 
@@ -88,6 +110,7 @@ class BaseViz(object):
             'token', 'token_' + uuid.uuid4().hex[:8])
         self.metrics = self.form_data.get('metrics') or []
         self.groupby = self.form_data.get('groupby') or []
+        self._query_obj = None
         self.reassignments()
 
     @classmethod
@@ -150,7 +173,7 @@ class BaseViz(object):
     def get_df(self, query_obj=None):
         """Returns a pandas dataframe based on the query object"""
         if not query_obj:
-            query_obj = self.query_obj()
+            query_obj = self.get_query_obj()
 
         self.error_msg = ""
         self.results = None
@@ -162,7 +185,7 @@ class BaseViz(object):
                 timestamp_format = dttm_col.python_date_format
 
         # The datasource here can be different backend but the interface is common
-        self.results = self.datasource.query(**query_obj)
+        self.results = self.run_query(query_obj)
         self.query = self.results.query
         df = self.results.df
         # Transform the timestamp we received from database to pandas supported
@@ -186,6 +209,220 @@ class BaseViz(object):
         df = df.fillna(0)
         return df
 
+    def run_query(self, query_obj):
+        """Runs the query against the datasource
+
+        Identical queries run once per request, as slices of a dashboard
+        often share the same query, and their results are shared. With
+        QUERY_RESULTS_CACHE_TIMEOUT, results are also cached across requests.
+        """
+        from caravel.models import QueryResult
+        key = hashlib.md5(json.dumps(
+            [self.datasource.type, self.datasource.id, query_obj],
+            sort_keys=True,
+            default=utils.json_iso_dttm_ser).encode('utf-8')).hexdigest()
+        timeout = config.get('QUERY_RESULTS_CACHE_TIMEOUT')
+        cache_key = 'query_results_' + key
+
+        def execute():
+            if timeout and self.form_data.get('force') != 'true':
+                cached = cache.get(cache_key)
+                if cached:
+                    logging.info("Serving query results from cache")
+                    return QueryResult(*cached)
+            duration = self.get_segment_duration(query_obj)
+            with self.query_slots():
+                if duration:
+                    results = self.run_segmented_query(query_obj, duration)
+                else:
+                    results = self.datasource.query(**query_obj)
+            if timeout:
+                try:
+                    cache.set(cache_key, tuple(results), timeout=timeout)
+                except Exception as e:
+                    logging.warning(
+                        "Could not cache key {}".format(cache_key))
+                    logging.exception(e)
+            return results
+
+        if not has_app_context():
+            return execute()
+        if not hasattr(g, 'query_results'):
+            g.query_results = utils.SharedResults()
+        results = g.query_results.get(key, execute)
+        # the dataframe gets altered by the visualizations
+        if results.df is not None:
+            results = results._replace(df=results.df.copy())
+        return results
+
+    def query_slots(self):
+        """Returns the slots to hold while querying the datasource
+
+        Only the databases cap their concurrent queries. The queries run in
+        the background, with ``g.low_priority`` set, yield to the others.
+        """
+        database = getattr(self.datasource, 'database', None)
+        if not hasattr(database, 'query_slots'):
+            return utils.SemaphoreSlots([])
+        user_id = None
+        low_priority = False
+        if has_app_context():
+            user = getattr(g, 'user', None)
+            user_id = user.get_id() if user else None
+            low_priority = getattr(g, 'low_priority', False)
+        return database.query_slots(
+            user_id=user_id,
+            low_priority=low_priority,
+            timeout=config.get('DB_CONCURRENCY_WAIT_TIMEOUT'))
+
+    def get_segment_duration(self, query_obj):
+        """Returns the duration of the buckets the results are cached by
+
+        Only queries whose buckets can be cached and queried independently
+        from one another are segmented, None is returned for the others.
+        """
+        if (
+                not config.get('QUERY_SEGMENT_CACHE_TIMEOUT') or
+                not query_obj.get('is_timeseries') or
+                query_obj.get('timeseries_limit') or
+                query_obj.get('columns')):
+            return None
+        return self.get_time_grain_duration(query_obj)
+
+    def get_time_grain_duration(self, query_obj):
+        """Returns the duration of the time buckets of the query
+
+        None is returned unless the buckets have a fixed duration and are
+        aligned on the epoch.
+        """
+        extras = query_obj.get('extras') or {}
+        duration = None
+        granularity = query_obj.get('granularity')
+        if self.datasource.type == 'druid':
+            from_dttm = query_obj['from_dttm'].replace(
+                tzinfo=config.get('DRUID_TZ'))
+            if (
+                    granularity and granularity != 'all' and
+                    not extras.get('druid_time_origin') and
+                    not from_dttm.utcoffset()):
+                duration = utils.parse_human_timedelta(granularity)
+        elif self.datasource.type == 'table':
+            duration = FIXED_TIME_GRAINS.get(extras.get('time_grain_sqla'))
+        if duration and duration.total_seconds() >= 1:
+            return duration
+
+    def run_segmented_query(self, query_obj, duration):
+        """Runs a timeseries query, caching its results per time bucket
+
+        The results of the closed buckets are cached under a key that
+        ignores the time range of the query, so that only the buckets
+        missing from the cache and the open ones at the edges of the range
+        get queried, in as few contiguous ranges as possible.
+        """
+        from caravel.models import QueryResult
+        qry_start_dttm = datetime.now()
+        from_dttm = query_obj['from_dttm']
+        to_dttm = query_obj['to_dttm']
+        row_limit = query_obj.get('row_limit')
+        timeout = config.get('QUERY_SEGMENT_CACHE_TIMEOUT')
+        step = duration.total_seconds()
+
+        def to_seconds(dttm):
+            return (dttm - utils.EPOCH).total_seconds()
+
+        def to_datetime(seconds):
+            return utils.EPOCH + timedelta(seconds=seconds)
+
+        base_qry = {
+            k: v for k, v in query_obj.items()
+            if k not in (
+                'from_dttm', 'to_dttm', 'inner_from_dttm', 'inner_to_dttm')}
+        key = 'query_segment_' + hashlib.md5(json.dumps(
+            [self.datasource.type, self.datasource.id, base_qry, step],
+            sort_keys=True,
+            default=utils.json_iso_dttm_ser).encode('utf-8')).hexdigest()
+
+        # The buckets fully within the range that won't receive any more
+        # data, the range's end excluded as sqla includes it
+        from_seconds = to_seconds(from_dttm)
+        closed_before = min(
+            to_seconds(to_dttm),
+            to_seconds(datetime.now()) - config.get('QUERY_SEGMENT_CACHE_LAG'))
+        buckets = []
+        bucket = -(-from_seconds // step) * step
+        if (closed_before - bucket) / step > SEGMENT_MAX_BUCKETS:
+            return self.datasource.query(**query_obj)
+        while bucket + step < closed_before:
+            buckets.append(bucket)
+            bucket += step
+
+        keys = ['{}_{}'.format(key, int(b)) for b in buckets]
+        cached = [None] * len(keys)
+        if keys and self.form_data.get('force') != 'true':
+            cached = cache.get_many(*keys)
+
+        # Contiguous ranges of the buckets to query, the last one ending
+        # with the query's range
+        ranges = []
+        start = from_seconds
+        for bucket, df in zip(buckets, cached):
+            if df is not None:
+                if start < bucket:
+                    ranges.append((start, bucket))
+                start = bucket + step
+        ranges.append((start, None))
+
+        frames = {b: df for b, df in zip(buckets, cached) if df is not None}
+        queries = []
+        to_cache = {}
+        for start, end in ranges:
+            qry = dict(
+                query_obj,
+                from_dttm=(
+                    from_dttm if start == from_seconds else to_datetime(start)),
+                to_dttm=to_dttm if end is None else to_datetime(end))
+            try:
+                results = self.datasource.query(**qry)
+            except Exception as e:
+                logging.exception(e)
+                results = None
+            df = results.df if results else None
+            if df is None or (row_limit and len(df) >= row_limit):
+                # leave it to the original query to report the error or
+                # to pick the rows making the cut
+                return self.datasource.query(**query_obj)
+            queries.append(results.query)
+            if not df.empty:
+                seconds = (
+                    (pd.to_datetime(df.timestamp, utc=False) -
+                        pd.Timestamp(utils.EPOCH)) / np.timedelta64(1, 's'))
+                if end is not None:
+                    df = df[(seconds < end).values]
+                    seconds = seconds[(seconds < end).values]
+                df_buckets = ((seconds // step) * step).values
+            frames[start] = df
+            for bucket, key_ in zip(buckets, keys):
+                if bucket >= start and (end is None or bucket < end):
+                    to_cache[key_] = (
+                        df[df_buckets == bucket] if not df.empty else df)
+
+        df = pd.concat(
+            [frames[k] for k in sorted(frames)], ignore_index=True)
+        if row_limit and len(df) > row_limit:
+            return self.datasource.query(**query_obj)
+        if to_cache:
+            try:
+                cache.set_many(to_cache, timeout=timeout)
+            except Exception as e:
+                logging.warning("Could not cache the query segments")
+                logging.exception(e)
+        logging.info("Served {} of {} time buckets from cache".format(
+            len(buckets) - len(to_cache), len(buckets)))
+        return QueryResult(
+            df=df,
+            query='\n\n'.join(queries),
+            duration=datetime.now() - qry_start_dttm)
+
     @property
     def form(self):
         return self.form_class(**self.form_data)
@@ -272,8 +509,26 @@ class BaseViz(object):
             'timeseries_limit': limit,
             'extras': extras,
         }
+        # Snapping the time range so that the requests made around the same
+        # time share their cache key, the timeseries to their time grain
+        snap = self.is_timeseries and self.get_time_grain_duration(d)
+        seconds = (
+            snap.total_seconds() if snap else config.get('CACHE_TIME_QUANTUM'))
+        if seconds:
+            d['from_dttm'] = utils.snap_datetime(from_dttm, seconds)
+            d['to_dttm'] = utils.snap_datetime(to_dttm, seconds, ceil=True)
         return d
 
+    def get_query_obj(self):
+        """Returns a copy of the query object, built once per viz
+
+        The cache key and the queries share the same snapped time range,
+        and the warnings of ``query_obj`` are only flashed once.
+        """
+        if self._query_obj is None:
+            self._query_obj = self.query_obj()
+        return copy.deepcopy(self._query_obj)
+
     @property
     def cache_timeout(self):
 
@@ -287,59 +542,203 @@ class BaseViz(object):
             return self.datasource.database.cache_timeout
         return config.get("CACHE_DEFAULT_TIMEOUT")
 
-    def get_json(self, force=False):
-        """Handles caching around the json payload retrieval"""
+    @property
+    def serve_stale(self):
+        if self.slice and self.slice.serve_stale is not None:
+            return self.slice.serve_stale
+        if getattr(self.datasource, 'serve_stale', None) is not None:
+            return self.datasource.serve_stale
+        return config.get("CACHE_SERVE_STALE")
+
+    def get_json(self, force=False, compress=False):
+        """Handles caching around the json payload retrieval
+
+        Only one request computes the payload for a given cache key at a
+        time, the others get served the previous payload if it's still
+        around, or wait for the fresh one to land in the cache.
+
+        The payload is serialized and compressed only once, when it's
+        computed, the fields that vary across requests are appended to the
+        cached payload. With ``compress``, the payload is returned as gzip.
+        """
         cache_key = self.cache_key
-        payload = None
+        entry = None
+        is_stale = False
         force = force if force else self.form_data.get('force') == 'true'
         if not force:
-            payload = cache.get(cache_key)
-
-        if payload:
+            entry, is_stale = self.get_cache_entry(cache_key)
+            if not entry and self.serve_stale:
+                # the payload of the time range's previous bounds
+                latest_key = cache.get(self.latest_cache_key)
+                if latest_key:
+                    entry, is_stale = self.get_cache_entry(latest_key)
+                    is_stale = bool(entry)
+
+        if entry and not is_stale:
             is_cached = True
+            logging.info("Serving from cache")
+        elif entry and self.serve_stale and self.refresh_async(cache_key):
+            is_cached = True
+            logging.info("Serving stale payload while it's refreshed")
+        else:
+            lock = utils.CacheLock(
+                cache, cache_key + '__lock',
+                timeout=config.get('CACHE_LOCK_TIMEOUT'))
+            if force or lock.acquire():
+                try:
+                    is_cached = False
+                    entry = self.get_payload(cache_key)
+                finally:
+                    lock.release()
+            elif entry:
+                is_cached = True
+                logging.info("Serving stale payload while it's refreshed")
+            else:
+                entry = self.wait_for_payload(cache_key, lock)
+                is_cached = bool(entry)
+                if not entry:
+                    entry = self.get_payload(cache_key)
+        # the cached payload is missing its closing brace, the fields that
+        # differ across the requests sharing the cache key are appended
+        tail = ', ' + self.json_dumps({
+            'csv_endpoint': self.csv_endpoint,
+            'form_data': self.form_data,
+            'is_cached': is_cached,
+            'is_stale': is_cached and is_stale,
+            'json_endpoint': self.json_endpoint,
+            'standalone_endpoint': self.standalone_endpoint,
+        })[1:]
+        if compress:
+            return utils.gzip_concat(
+                entry['deflated'], entry['crc'], entry['size'],
+                tail.encode('utf-8'))
+        return entry['payload'] + tail
+
+    def refresh_async(self, cache_key):
+        """Schedules the payload to be recomputed by a celery worker
+
+        Returns False when the refresh could not be scheduled, in which
+        case the payload has to be computed in the request.
+        """
+        if not config.get('CELERY_CONFIG'):
+            return False
+        lock = utils.CacheLock(
+            cache, cache_key + '__lock',
+            timeout=config.get('CACHE_LOCK_TIMEOUT'))
+        if not lock.acquire():
+            # the payload is already being recomputed
+            return True
+        from caravel.tasks import refresh_payload
+        form_data = self.orig_form_data
+        if isinstance(form_data, (MultiDict, ImmutableMultiDict)):
+            form_data = form_data.to_dict(flat=False)
+        try:
+            refresh_payload.delay(
+                self.datasource.type, self.datasource.id, form_data,
+                lock.key, lock.token)
+        except Exception as e:
+            logging.warning("Could not schedule the refresh of {}".format(
+                cache_key))
+            logging.exception(e)
+            lock.release()
+            return False
+        return True
+
+    def get_payload(self, cache_key):
+        """Computes the payload, caches it and returns its cache entry"""
+        cache_timeout = self.cache_timeout
+        payload = {
+            'cache_timeout': cache_timeout,
+            'cache_key': cache_key,
+            'data': self.get_data(),
+            'query': self.query,
+        }
+        payload['cached_dttm'] = datetime.now().isoformat().split('.')[0]
+        data = self.json_dumps(payload)
+        data = data[:data.rindex('}')]
+        deflated, crc, size = utils.sync_deflate(data.encode('utf-8'))
+        # Expired payloads are kept around for a while so they can be
+        # served while a fresh one is being computed
+        entry = {
+            'expires': time.time() + cache_timeout if cache_timeout else None,
+            'deflated': deflated,
+            'crc': crc,
+            'size': size,
+        }
+        logging.info("Caching for the next {} seconds".format(
+            cache_timeout))
+        timeout = (
+            cache_timeout + config.get('CACHE_STALE_TIMEOUT')
+            if cache_timeout else cache_timeout)
+        try:
+            cache.set(cache_key, entry, timeout=timeout)
+            if self.serve_stale:
+                cache.set(self.latest_cache_key, cache_key, timeout=timeout)
+        except Exception as e:
+            # cache.set call can fail if the backend is down or if
+            # the key is too large or whatever other reasons
+            logging.warning("Could not cache key {}".format(cache_key))
+            logging.exception(e)
+            cache.delete(cache_key)
+        entry = dict(entry, payload=data)
+        self.set_local_cache_entry(cache_key, entry)
+        return entry
+
+    def set_local_cache_entry(self, cache_key, entry):
+        """Keeps the cache entry in the in-process cache
+
+        Only the payloads the backend caches for a set time are kept, so
+        that the in-process cache is off along with the backend's.
+        """
+        if not entry['expires'] or isinstance(cache.cache, NullCache):
+            return
+        timeout = min(
+            config.get('CACHE_LOCAL_TIMEOUT'),
+            entry['expires'] + config.get('CACHE_STALE_TIMEOUT') - time.time())
+        if timeout > 0:
+            local_cache.set(
+                cache_key, entry, timeout=timeout,
+                size=len(entry['payload']) + len(entry['deflated']))
+
+    def get_cache_entry(self, cache_key):
+        """Returns the ``(cache entry, is_stale)`` for the key
+
+        Looks in the in-process cache first, then in the cache backend.
+        Cache entries hold the serialized payload without its closing brace,
+        both as text and compressed by ``utils.sync_deflate``.
+        """
+        entry = local_cache.get(cache_key)
+        if entry and entry['expires'] and entry['expires'] < time.time():
+            # the backend may hold a fresher payload
+            entry = None
+        if not entry:
+            entry = cache.get(cache_key)
+            if not isinstance(entry, dict) or 'deflated' not in entry:
+                return None, False
             try:
-                cached_data = zlib.decompress(payload)
-                if PY3:
-                    cached_data = cached_data.decode('utf-8')
-                payload = json.loads(cached_data)
+                data = utils.inflate(entry['deflated']).decode('utf-8')
             except Exception as e:
                 logging.error("Error reading cache: " +
                               utils.error_msg_from_exception(e))
-                payload = None
-            logging.info("Serving from cache")
-
-        if not payload:
-            is_cached = False
-            cache_timeout = self.cache_timeout
-            payload = {
-                'cache_timeout': cache_timeout,
-                'cache_key': cache_key,
-                'csv_endpoint': self.csv_endpoint,
-                'data': self.get_data(),
-                'form_data': self.form_data,
-                'json_endpoint': self.json_endpoint,
-                'query': self.query,
-                'standalone_endpoint': self.standalone_endpoint,
-            }
-            payload['cached_dttm'] = datetime.now().isoformat().split('.')[0]
-            logging.info("Caching for the next {} seconds".format(
-                cache_timeout))
-            try:
-                data = self.json_dumps(payload)
-                if PY3:
-                    data = bytes(data, 'utf-8')
-                cache.set(
-                    cache_key,
-                    zlib.compress(data),
-                    timeout=cache_timeout)
-            except Exception as e:
-                # cache.set call can fail if the backend is down or if
-                # the key is too large or whatever other reasons
-                logging.warning("Could not cache key {}".format(cache_key))
-                logging.exception(e)
-                cache.delete(cache_key)
-        payload['is_cached'] = is_cached
-        return self.json_dumps(payload)
+                return None, False
+            entry = dict(entry, payload=data)
+            self.set_local_cache_entry(cache_key, entry)
+        expires = entry['expires']
+        return entry, bool(expires and expires < time.time())
+
+    def wait_for_payload(self, cache_key, lock):
+        """Waits for the request holding the lock to cache the payload"""
+        deadline = time.time() + config.get('CACHE_WAIT_TIMEOUT')
+        while time.time() < deadline:
+            time.sleep(0.2)
+            released = not lock.locked()
+            entry, is_stale = self.get_cache_entry(cache_key)
+            if entry and not is_stale:
+                return entry
+            if released:
+                break
+        logging.warning(
+            "Gave up waiting on the payload for {}".format(cache_key))
 
     def json_dumps(self, obj):
         """Used by get_json, can be overridden to use specific switches"""
@@ -377,8 +776,48 @@ class BaseViz(object):
 
     @property
     def cache_key(self):
-        url = self.get_url(for_cache_key=True, json="true", force="false")
-        return hashlib.md5(url.encode('utf-8')).hexdigest()
+        """Hashes the resolved query along with the options shaping the data
+
+        Requests for the same data share their cache key whatever the order
+        of their params or the wording of their time range.
+        """
+        return self.get_cache_key()
+
+    @property
+    def latest_cache_key(self):
+        """Hashes the query along with its time range as worded
+
+        Holds the cache key of the latest payload cached for the query. The
+        cache key of a relative time range, e.g. "7 days ago", changes
+        as its snapped bounds move on. The time range is kept as worded
+        here, so that the payload cached for the previous bounds can be
+        served stale while the one for the current bounds is computed.
+        """
+        return self.get_cache_key(latest=True)
+
+    def get_cache_key(self, latest=False):
+        options = {
+            k: v for k, v in self.form_data.items()
+            if k not in CACHE_KEY_EXCLUDED_FIELDS}
+        try:
+            query_obj = self.get_query_obj()
+        except Exception:
+            # let the payload computation report the error
+            url = self.get_url(for_cache_key=True, json="true", force="false")
+            if latest:
+                url += '&latest=true'
+            return hashlib.md5(url.encode('utf-8')).hexdigest()
+        if latest:
+            extra_filters = self.get_extra_filters()
+            del query_obj['from_dttm'], query_obj['to_dttm']
+            options['__latest'] = [
+                extra_filters.get('__from') or self.form_data.get('since'),
+                extra_filters.get('__to') or self.form_data.get('until')]
+        return hashlib.md5(json.dumps(
+            [self.datasource.type, self.datasource.id, self.viz_type,
+             query_obj, options],
+            sort_keys=True,
+            default=utils.json_iso_dttm_ser).encode('utf-8')).hexdigest()
 
     @property
     def csv_endpoint(self):
@@ -1128,7 +1567,7 @@ class NVD3TimeSeriesViz(NVD3Viz):
 
         time_compare = self.form_data.get('time_compare')
         if time_compare:
-            query_object = self.query_obj()
+            query_object = self.get_query_obj()
             delta = utils.parse_human_timedelta(time_compare)
             query_object['inner_from_dttm'] = query_object['from_dttm']
             query_object['inner_to_dttm'] = query_object['to_dttm']
@@ -1276,7 +1715,7 @@ class HistogramViz(BaseViz):
     def get_df(self, query_obj=None):
         """Returns a pandas dataframe based on the query object"""
         if not query_obj:
-            query_obj = self.query_obj()
+            query_obj = self.get_query_obj()
 
         self.results = self.datasource.query(**query_obj)
         self.query = self.results.query
@@ -1667,7 +2106,7 @@ class FilterBoxViz(BaseViz):
         return qry
 
     def get_data(self):
-        qry = self.query_obj()
+        qry = self.get_query_obj()
         filters = [g for g in self.form_data['groupby']]
         d = {}
         for flt in filters:
@@ -8,10 +8,12 @@ import imp
 import json
 import os
 import subprocess
+import sys
 import time
 import unittest
 
 import pandas as pd
+from flask_appbuilder.security.sqla import models as ab_models
 
 import caravel
 from caravel import app, appbuilder, db, models, sql_lab, utils, dataframe
@@ -26,7 +28,7 @@ cli = imp.load_source('cli', BASE_DIR + '/bin/caravel')
 
 class CeleryConfig(object):
     BROKER_URL = 'sqla+sqlite:///' + app.config.get('SQL_CELERY_DB_FILE_PATH')
-    CELERY_IMPORTS = ('caravel.sql_lab', )
+    CELERY_IMPORTS = ('caravel.sql_lab', 'caravel.tasks', )
     CELERY_RESULT_BACKEND = 'db+sqlite:///' + app.config.get('SQL_CELERY_RESULTS_DB_FILE_PATH')
     CELERY_ANNOTATIONS = {'sql_lab.add': {'rate_limit': '10/s'}}
     CONCURRENCY = 1
@@ -70,6 +72,56 @@ class UtilityFunctionTests(CaravelTestCase):
             expected_updated_multi_line_query,
             updated_multi_line_query)
 
+    def test_fetch_chunks(self):
+        class ResultProxy(object):
+            def __init__(self, rows):
+                self.rows = rows
+                self.closed = False
+
+            def fetchmany(self, size):
+                rows, self.rows = self.rows[:size], self.rows[size:]
+                return rows
+
+            def close(self):
+                self.closed = True
+
+        result_proxy = ResultProxy(list(range(10)))
+        self.assertEqual(
+            [[0, 1, 2, 3], [4, 5, 6, 7], [8, 9]],
+            list(sql_lab.fetch_chunks(result_proxy, 4)))
+        self.assertTrue(result_proxy.closed)
+
+        # the rows past the limit are not fetched
+        result_proxy = ResultProxy(list(range(10)))
+        self.assertEqual(
+            [[0, 1, 2, 3], [4, 5]],
+            list(sql_lab.fetch_chunks(result_proxy, 4, limit=6)))
+        self.assertEqual([6, 7, 8, 9], result_proxy.rows)
+
+    def test_order_mixed_types(self):
+        from mock import Mock, patch
+        from werkzeug.contrib.cache import SimpleCache
+        with patch('caravel.sql_lab.results_backend', SimpleCache()):
+            writer = sql_lab.ResultsWriter('mixed', 2)
+            for values in ([3, 'b'], [None, 1.5], ['a']):
+                writer.add_chunk(Mock(columnar_data={'v': values}))
+            writer.close({
+                'query_id': 1, 'status': 'success', 'rows': 5,
+                'columns': [{'name': 'v'}], 'query': {}})
+            results = sql_lab.get_results('mixed', order_by='v')
+            self.assertEqual(
+                [1.5, 3, 'a', 'b', None],
+                [row['v'] for row in results['data']])
+
+            writer = sql_lab.ResultsWriter('unorderable', 2)
+            writer.add_chunk(Mock(columnar_data={'v': [{'a': 1}, {'b': 2}]}))
+            writer.close({
+                'query_id': 1, 'status': 'success', 'rows': 2,
+                'columns': [{'name': 'v'}], 'query': {}})
+            if sys.version_info >= (3, ):
+                with self.assertRaises(ValueError):
+                    sql_lab.get_results('unorderable', order_by='v')
+
 
 class CeleryTestCase(CaravelTestCase):
     def __init__(self, *args, **kwargs):
@@ -251,6 +303,188 @@ class CeleryTestCase(CaravelTestCase):
         self.assertEqual(True, query1.select_as_cta)
         self.assertEqual(True, query1.select_as_cta_used)
 
+    def test_store_results(self):
+        from mock import patch
+        from werkzeug.contrib.cache import SimpleCache
+        results_backend = SimpleCache()
+        sql = "SELECT id, name FROM ab_permission"
+        names = [
+            p.name for p in db.session.query(ab_models.Permission).all()]
+        session = db.session
+        query = models.Query(
+            database_id=1, sql=sql, client_id='store_1', limit=666,
+            select_as_cta=False, start_time=utils.now_as_float())
+        session.add(query)
+        session.commit()
+        query_id = query.id
+
+        chunk_size = app.config.get('SQL_FETCH_CHUNK_SIZE')
+        app.config['SQL_FETCH_CHUNK_SIZE'] = 3
+        try:
+            with patch('caravel.sql_lab.results_backend', results_backend), \
+                    patch('caravel.views.results_backend', results_backend):
+                sql_lab.get_sql_results(
+                    query_id, return_results=False, store_results=True)
+                query = self.get_query_by_id(query_id)
+                self.assertEqual(QueryStatus.SUCCESS, query.status)
+                self.assertTrue(query.results_key)
+
+                self.login()
+                url = '/caravel/results/{}/'.format(query.results_key)
+                data = json.loads(self.get_resp(url))
+                window = json.loads(self.get_resp(
+                    url + '?offset=2&limit=4&columns=name&order_by=name'))
+                self.logout()
+        finally:
+            app.config['SQL_FETCH_CHUNK_SIZE'] = chunk_size
+        self.assertEqual(
+            sorted(names), sorted([row['name'] for row in data['data']]))
+        self.assertEqual(query.results_key, data['query']['resultsKey'])
+        self.assertEqual(len(names), window['rows'])
+        self.assertEqual(
+            [{'name': name} for name in sorted(names)[2:6]], window['data'])
+
+    def test_stop_query(self):
+        session = db.session
+        query = models.Query(
+            database_id=1, sql="SELECT * FROM ab_permission",
+            client_id='stop_1', limit=666, select_as_cta=False,
+            status=QueryStatus.PENDING, start_time=utils.now_as_float())
+        session.add(query)
+        session.commit()
+        query_id = query.id
+
+        self.login()
+        resp = self.client.post(
+            '/caravel/stop_query/', data=dict(client_id='stop_1'))
+        self.logout()
+        data = json.loads(resp.data.decode('utf-8'))
+        self.assertEqual(QueryStatus.STOPPED, data['query']['state'])
+
+        # the worker picking the query up doesn't run it
+        with self.assertRaises(Exception):
+            sql_lab.get_sql_results(query_id, return_results=False)
+        query = self.get_query_by_id(query_id)
+        self.assertEqual(QueryStatus.STOPPED, query.status)
+        self.assertIsNone(query.executed_sql)
+        self.assertTrue(query.end_time)
+
+    def test_stop_query_while_queued(self):
+        from mock import patch
+        session = db.session
+        query = models.Query(
+            database_id=1, sql="SELECT * FROM ab_permission",
+            client_id='stop_2', limit=666, select_as_cta=False,
+            status=QueryStatus.PENDING, start_time=utils.now_as_float())
+        session.add(query)
+        session.commit()
+        query_id = query.id
+        table = models.Query.__table__
+
+        def stop():
+            db.engine.execute(
+                table.update()
+                .where(table.c.id == query_id)
+                .values(status=QueryStatus.STOPPED))
+
+        # stopped right before the worker flags the query as running
+        with patch('caravel.utils.SemaphoreSlots.acquire', side_effect=stop):
+            with self.assertRaises(Exception):
+                sql_lab.get_sql_results(query_id, return_results=False)
+        query = self.get_query_by_id(query_id)
+        self.assertEqual(QueryStatus.STOPPED, query.status)
+
+    def test_stop_query_before_success(self):
+        from mock import patch
+        session = db.session
+        query = models.Query(
+            database_id=1, sql="SELECT * FROM ab_permission",
+            client_id='stop_3', limit=666, select_as_cta=False,
+            status=QueryStatus.PENDING, start_time=utils.now_as_float())
+        session.add(query)
+        session.commit()
+        query_id = query.id
+        table = models.Query.__table__
+
+        def stop_after_check(engine, query_id):
+            db.engine.execute(
+                table.update()
+                .where(table.c.id == query_id)
+                .values(status=QueryStatus.STOPPED))
+            return QueryStatus.RUNNING
+
+        # stopped right after the worker checks the query's status
+        with patch('caravel.sql_lab.get_query_status',
+                   side_effect=stop_after_check):
+            with self.assertRaises(Exception):
+                sql_lab.get_sql_results(query_id, return_results=False)
+        query = self.get_query_by_id(query_id)
+        self.assertEqual(QueryStatus.STOPPED, query.status)
+
+    def test_stop_sync_query(self):
+        from mock import patch
+        get_query_status = sql_lab.get_query_status
+        table = models.Query.__table__
+
+        def stop(engine, query_id):
+            db.engine.execute(
+                table.update()
+                .where(table.c.id == query_id)
+                .values(status=QueryStatus.STOPPED))
+            return get_query_status(engine, query_id)
+
+        with patch('caravel.sql_lab.get_query_status', side_effect=stop):
+            data = self.run_sql(1, "SELECT * FROM ab_permission", 'stop_4')
+        # not reported as an error
+        self.assertEqual(QueryStatus.STOPPED, data['status'])
+        self.assertNotIn('error', data)
+        self.assertEqual(QueryStatus.STOPPED, data['query']['state'])
+
+    def test_cancel_on_error(self):
+        from mock import patch
+        session = db.session
+        query = models.Query(
+            database_id=1, sql="SELECT * FROM no_such_table",
+            client_id='cancel_1', limit=666, select_as_cta=False,
+            status=QueryStatus.PENDING, start_time=utils.now_as_float())
+        session.add(query)
+        session.commit()
+        query_id = query.id
+
+        with patch('caravel.models.Database.cancel_query') as cancel_query:
+            with self.assertRaises(Exception):
+                sql_lab.get_sql_results(query_id, return_results=False)
+        self.assertEqual(1, cancel_query.call_count)
+        query = self.get_query_by_id(query_id)
+        self.assertEqual(QueryStatus.FAILED, query.status)
+
+    def test_worker_user(self):
+        from flask import g
+        from flask_login import current_user
+        from mock import patch
+        from caravel import tasks, viz
+        slc = db.session.query(models.Slice).first()
+        users = []
+
+        def get_json(viz_obj, force=False, compress=False):
+            users.append(
+                (g.user.username, getattr(current_user, 'username', None)))
+            return '{}'
+
+        app.config['CACHE_WORKER_USER'] = 'admin'
+        try:
+            with patch.object(viz.BaseViz, 'get_json', get_json):
+                result = tasks.warm_up_slice(slc.id)
+                tasks.refresh_payload(
+                    slc.datasource_type, slc.datasource_id, {
+                        'viz_type': [slc.viz_type],
+                        'slice_id': ['{}'.format(slc.id)],
+                    })
+        finally:
+            app.config['CACHE_WORKER_USER'] = None
+        self.assertTrue(result['success'])
+        self.assertEqual([('admin', 'admin')] * 2, users)
+
     def test_get_columns_dict(self):
         main_db = db.session.query(models.Database).filter_by(
             database_name='main').first()
@@ -15,7 +15,7 @@ import unittest
 from flask import escape
 from flask_appbuilder.security.sqla import models as ab_models
 
-from caravel import db, models, utils, appbuilder, sm
+from caravel import app, db, models, utils, appbuilder, sm
 
 from .base_tests import CaravelTestCase
 
@@ -120,6 +120,91 @@ class CoreTests(CaravelTestCase):
         for title, url in urls.items():
             assert escape(title) in self.client.get(url).data.decode('utf-8')
 
+    def test_dashboard_data(self):
+        self.login(username='admin')
+        dash = db.session.query(models.Dashboard).filter_by(
+            slug="births").first()
+        resp = self.get_resp('/caravel/dashboard/births/data')
+        lines = [json.loads(l) for l in resp.splitlines()]
+        assert (
+            sorted([l['slice_id'] for l in lines]) ==
+            sorted([slc.id for slc in dash.slices]))
+        for line in lines:
+            assert 'error' not in line
+            assert 'data' in line['payload']
+
+        # a slice whose datasource was deleted only fails its own line
+        slc = models.Slice(
+            slice_name='Orphan', viz_type='table', datasource_type='table',
+            datasource_id=dash.slices[0].datasource_id,
+            params=json.dumps({'viz_type': 'table'}))
+        dash.slices.append(slc)
+        db.session.commit()
+        slice_id = slc.id
+        table = models.Slice.__table__
+        db.session.execute(
+            table.update()
+            .where(table.c.id == slice_id)
+            .values(datasource_id=99999))
+        db.session.commit()
+        try:
+            resp = self.get_resp('/caravel/dashboard/births/data')
+        finally:
+            dash.slices.remove(slc)
+            db.session.delete(slc)
+            db.session.commit()
+        lines = {
+            l['slice_id']: l for l in map(json.loads, resp.splitlines())}
+        assert len(lines) == len(dash.slices) + 1
+        assert 'error' in lines.pop(slice_id)
+        for line in lines.values():
+            assert 'data' in line['payload']
+
+    def test_segmented_query(self):
+        from datetime import datetime, timedelta
+        from mock import patch
+        from werkzeug.contrib.cache import SimpleCache
+        slc = db.session.query(models.Slice).filter_by(
+            slice_name='Trends').first()
+        viz_obj = slc.get_viz()
+        query_obj = viz_obj.query_obj()
+        query_obj['timeseries_limit'] = 0
+        query_obj['extras']['time_grain_sqla'] = 'day'
+        query_obj['from_dttm'] = datetime(1999, 12, 25, 12)
+        query_obj['to_dttm'] = datetime(2000, 1, 5, 12)
+
+        def records(df):
+            df = df.sort_values(['timestamp', 'name'])
+            return df.values.tolist()
+
+        expected = records(viz_obj.datasource.query(**query_obj).df)
+        app.config['QUERY_SEGMENT_CACHE_TIMEOUT'] = 60
+        try:
+            with patch('caravel.viz.cache', SimpleCache()):
+                duration = viz_obj.get_segment_duration(query_obj)
+                assert duration == timedelta(days=1)
+                # the second run is served from the cached buckets
+                for i in range(2):
+                    results = viz_obj.run_segmented_query(query_obj, duration)
+                    assert records(results.df) == expected
+        finally:
+            app.config['QUERY_SEGMENT_CACHE_TIMEOUT'] = 0
+
+    def test_warm_up_dashboards(self):
+        from caravel import tasks
+        self.login(username='admin')
+        self.get_resp('/caravel/dashboard/births/')
+        dash = db.session.query(models.Dashboard).filter_by(
+            slug="births").first()
+        results = tasks.warm_up_dashboards(limit=100)
+        slice_ids = [r['slice_id'] for r in results]
+        for slc in dash.slices:
+            assert slc.id in slice_ids
+        assert all([r['success'] for r in results])
+        logs = db.session.query(models.Log).filter_by(
+            action='warm_up_cache').all()
+        assert len(logs) >= len(results)
+
     def test_doctests(self):
         modules = [utils, models]
         for mod in modules:
@@ -156,6 +241,212 @@ class CoreTests(CaravelTestCase):
         assert response.status_code == 200
 
 
+    def test_engine_registry(self):
+        database = (
+            db.session
+            .query(models.Database)
+            .filter_by(database_name='main')
+            .first()
+        )
+        engine = database.get_sqla_engine()
+        assert engine is database.get_sqla_engine()
+        assert engine is not database.get_sqla_engine(schema='main')
+
+        extra = database.extra
+        database.extra = json.dumps(
+            {'engine_params': {'pool_recycle': 60}})
+        db.session.commit()
+        assert engine is not database.get_sqla_engine()
+
+        database.extra = extra
+        db.session.commit()
+
+    def test_fetch_metadata(self):
+        tbl = db.session.query(models.SqlaTable).filter_by(
+            table_name='energy_usage').first()
+        col = [c for c in tbl.columns if c.column_name == 'value'][0]
+        db.session.delete(col)
+        db.session.commit()
+
+        changes = tbl.fetch_metadata()
+        assert changes['added_columns'] == ['value']
+        assert changes['added_metrics'] == []
+        assert 'value' in [c.column_name for c in tbl.columns]
+
+        changes = tbl.fetch_metadata()
+        assert changes == {
+            'added_columns': [], 'changed_columns': [], 'added_metrics': []}
+
+    def test_query_slots(self):
+        from mock import patch
+        from werkzeug.contrib.cache import SimpleCache
+        from caravel import cache
+        database = db.session.query(models.Database).filter_by(
+            database_name='main').first()
+        app.config['DB_CONCURRENCY_LIMIT'] = 1
+        try:
+            with patch.dict(app.extensions['cache'], {cache: SimpleCache()}):
+                with database.query_slots(timeout=0):
+                    with self.assertRaises(utils.CaravelException):
+                        database.query_slots(timeout=0).acquire()
+                # the slot is free again
+                with database.query_slots(timeout=0):
+                    pass
+        finally:
+            app.config['DB_CONCURRENCY_LIMIT'] = None
+
+    def test_gzip_json_endpoint(self):
+        import gzip
+        from mock import patch
+        from werkzeug.contrib.cache import SimpleCache
+        from caravel import cache
+        self.login(username='admin')
+        slc = db.session.query(models.Slice).first()
+        url = slc.viz.json_endpoint
+        payloads = []
+        with patch.dict(app.extensions['cache'], {cache: SimpleCache()}), \
+                patch('caravel.viz.local_cache', utils.LRUCache(10 ** 7)):
+            for i in range(2):
+                resp = self.client.get(
+                    url, headers={'Accept-Encoding': 'gzip'})
+                assert resp.headers['Content-Encoding'] == 'gzip'
+                data = gzip.GzipFile(fileobj=io.BytesIO(resp.data)).read()
+                payloads.append(json.loads(data.decode('utf-8')))
+            # the cached payload also gets served as text
+            payloads.append(json.loads(self.get_resp(url)))
+        assert not payloads[0]['is_cached']
+        assert payloads[1]['is_cached'] and payloads[2]['is_cached']
+        assert payloads[0]['data'] == payloads[1]['data'] == payloads[2]['data']
+        assert payloads[1]['form_data'] == payloads[0]['form_data']
+
+    def test_serve_stale(self):
+        slc = db.session.query(models.Slice).first()
+        viz_obj = slc.get_viz()
+        assert viz_obj.serve_stale == app.config.get('CACHE_SERVE_STALE')
+
+        slc.datasource.serve_stale = True
+        assert viz_obj.serve_stale is True
+        slc.serve_stale = False
+        assert viz_obj.serve_stale is False
+
+        slc.serve_stale = None
+        slc.datasource.serve_stale = None
+        db.session.commit()
+
+    def test_refresh_stale_payload(self):
+        import time
+        from mock import patch
+        from werkzeug.contrib.cache import SimpleCache
+        from caravel import cache
+        slc = db.session.query(models.Slice).first()
+        slc.serve_stale = True
+        viz_obj = slc.get_viz()
+        with app.test_request_context(), \
+                patch.dict(app.extensions['cache'], {cache: SimpleCache()}), \
+                patch('caravel.viz.local_cache', utils.LRUCache(10 ** 7)), \
+                patch('caravel.tasks.refresh_payload') as refresh_payload:
+            viz_obj.get_json()
+            cache_key = viz_obj.cache_key
+            entry = cache.get(cache_key)
+            entry['expires'] = time.time() - 1
+            cache.set(cache_key, entry)
+
+            data = json.loads(viz_obj.get_json())
+            assert data['is_cached'] and data['is_stale']
+            assert refresh_payload.delay.call_count == 1
+            lock = utils.CacheLock(cache, cache_key + '__lock')
+            assert lock.locked()
+            # the refresh is only scheduled once
+            data = json.loads(viz_obj.get_json())
+            assert data['is_stale']
+            assert refresh_payload.delay.call_count == 1
+        slc.serve_stale = None
+        db.session.commit()
+
+    def test_local_cache_off(self):
+        from mock import patch
+        slc = db.session.query(models.Slice).first()
+        slc.cache_timeout = 60
+        local_cache = utils.LRUCache(10 ** 7)
+        # the test config has the `null` cache type
+        with app.test_request_context(), \
+                patch('caravel.viz.local_cache', local_cache):
+            slc.get_viz().get_json()
+            assert local_cache.size == 0
+            data = json.loads(slc.get_viz().get_json())
+            assert not data['is_cached']
+        slc.cache_timeout = None
+        db.session.commit()
+
+    def test_cache_key(self):
+        from mock import patch
+        from caravel import viz
+        tbl = db.session.query(models.SqlaTable).filter_by(
+            table_name='birth_names').first()
+        form_data = {
+            'viz_type': 'table',
+            'granularity': 'ds',
+            'groupby': ['name'],
+            'metrics': ['sum__num'],
+            'since': '2016-01-01',
+            'until': '2016-02-01',
+        }
+
+        def cache_key(**kwargs):
+            return viz.viz_types['table'](
+                tbl, dict(form_data, **kwargs)).cache_key
+
+        key = cache_key()
+        assert cache_key(since='January 1, 2016') == key
+        assert cache_key(slice_name='Renamed') == key
+        assert cache_key(metrics=['sum__sum_girls']) != key
+        assert cache_key(until='2016-03-01') != key
+
+        # the query object is built once for the key and the query
+        with patch('caravel.viz.flasher') as flasher:
+            viz_obj = viz.viz_types['table'](
+                tbl, dict(form_data, since='2016-03-01'))
+            flasher.reset_mock()
+            viz_obj.cache_key
+            viz_obj.get_query_obj()
+            assert flasher.call_count == 1
+
+    def test_serve_previous_bounds(self):
+        from mock import patch
+        from werkzeug.contrib.cache import SimpleCache
+        from caravel import cache, viz
+        tbl = db.session.query(models.SqlaTable).filter_by(
+            table_name='birth_names').first()
+        tbl.serve_stale = True
+        form_data = {
+            'viz_type': 'table',
+            'granularity': 'ds',
+            'groupby': ['name'],
+            'metrics': ['sum__num'],
+            'since': '100 years ago',
+            'until': 'now',
+        }
+        quantum = app.config.get('CACHE_TIME_QUANTUM')
+        with app.test_request_context(), \
+                patch.dict(app.extensions['cache'], {cache: SimpleCache()}), \
+                patch('caravel.viz.local_cache', utils.LRUCache(10 ** 7)), \
+                patch('caravel.tasks.refresh_payload') as refresh_payload:
+            viz_obj = viz.viz_types['table'](tbl, form_data)
+            viz_obj.get_json()
+            # the bounds of the time range moved on
+            app.config['CACHE_TIME_QUANTUM'] = 24 * 60 * 60
+            try:
+                later = viz.viz_types['table'](tbl, form_data)
+                assert later.cache_key != viz_obj.cache_key
+                assert later.latest_cache_key == viz_obj.latest_cache_key
+                data = json.loads(later.get_json())
+            finally:
+                app.config['CACHE_TIME_QUANTUM'] = quantum
+            assert data['is_cached'] and data['is_stale']
+            assert refresh_payload.delay.call_count == 1
+        tbl.serve_stale = None
+        db.session.commit()
+
     def test_warm_up_cache(self):
         slice = db.session.query(models.Slice).first()
         resp = self.get_resp(
@@ -4,6 +4,7 @@ from __future__ import division
 from __future__ import print_function
 from __future__ import unicode_literals
 
+from copy import deepcopy
 from datetime import datetime
 import json
 import unittest
@@ -11,7 +12,7 @@ import unittest
 from mock import Mock, patch
 
 from caravel import db, sm, utils
-from caravel.models import DruidCluster, DruidDatasource
+from caravel.models import DruidCluster, DruidDatasource, DruidMetric
 
 from .base_tests import CaravelTestCase
 from flask_appbuilder.security.sqla import models as ab_models
@@ -227,6 +228,116 @@ class DruidTests(CaravelTestCase):
         assert 'datasource_for_gamma' in resp
         assert 'datasource_not_for_gamma' not in resp
 
+    def test_series_filter(self):
+        import pandas as pd
+        from pydruid.utils.filters import Filter
+        cluster = DruidCluster(cluster_name='series_cluster')
+        datasource = DruidDatasource(
+            datasource_name='series_datasource', cluster=cluster)
+        df = pd.DataFrame({
+            'dim1': ['a', 'a', 'b'],
+            'dim2': ['x', 'y', 'x'],
+        })
+
+        cluster.druid_version = '0.8.3'
+        filt = Filter.build_filter(
+            datasource.get_series_filter(df, ['dim1']))
+        assert filt['type'] == 'or'
+        assert [f['value'] for f in filt['fields']] == ['a', 'b']
+
+        cluster.druid_version = '0.9.1'
+        filt = Filter.build_filter(
+            datasource.get_series_filter(df, ['dim1']))
+        assert filt == {'type': 'in', 'dimension': 'dim1', 'values': ['a', 'b']}
+
+        filt = Filter.build_filter(
+            datasource.get_series_filter(df, ['dim1', 'dim2']))
+        assert filt == {'type': 'or', 'fields': [
+            {'type': 'and', 'fields': [
+                {'type': 'selector', 'dimension': 'dim1', 'value': 'a'},
+                {'type': 'in', 'dimension': 'dim2', 'values': ['x', 'y']},
+            ]},
+            {'type': 'and', 'fields': [
+                {'type': 'selector', 'dimension': 'dim1', 'value': 'b'},
+                {'type': 'selector', 'dimension': 'dim2', 'value': 'x'},
+            ]},
+        ]}
+
+    @patch('caravel.models.PyDruid')
+    def test_query_types(self, PyDruid):
+        import pandas as pd
+        from pydruid.query import QueryBuilder
+        from pydruid.utils.filters import Filter
+        cluster = DruidCluster(
+            cluster_name='query_types_cluster', druid_version='0.9.1')
+        datasource = DruidDatasource(
+            datasource_name='query_types_datasource', cluster=cluster)
+        datasource.metrics = [DruidMetric(
+            metric_name='count', metric_type='count',
+            json=json.dumps({'type': 'count', 'name': 'count'}))]
+        client = PyDruid.return_value
+        client.query_builder.last_query.query_dict = {}
+        df = pd.DataFrame({
+            'timestamp': ['2016-01-01', '2016-01-01', '2016-01-02'],
+            'dim1': ['a', 'b', 'a'],
+            'count': [3, 2, 1],
+        })
+        client.export_pandas.return_value = df
+
+        def query(**kwargs):
+            return datasource.query(
+                metrics=['count'],
+                from_dttm=datetime(2016, 1, 1),
+                to_dttm=datetime(2016, 1, 3),
+                filter=[],
+                extras={'having_druid': []},
+                **kwargs)
+
+        def get_query(method, query_type):
+            """Returns the args of the last query, checked by pydruid"""
+            kwargs = method.call_args[1]
+            getattr(QueryBuilder(), query_type)(deepcopy(kwargs))
+            return kwargs
+
+        client.export_pandas.return_value = pd.DataFrame({
+            'timestamp': ['2016-01-01', '2016-01-02', '2016-01-03'],
+            'count': [1, 3, 2],
+        })
+        results = query(
+            groupby=[], granularity='one day', is_timeseries=True,
+            row_limit=2)
+        qry = get_query(client.timeseries, 'timeseries')
+        assert 'dimensions' not in qry and 'limit_spec' not in qry
+        assert qry['context'] == {'skipEmptyBuckets': True}
+        # the top buckets are kept
+        assert results.df.to_dict(orient='list') == {
+            'timestamp': ['2016-01-02', '2016-01-03'], 'count': [3, 2]}
+        client.export_pandas.return_value = df
+
+        query(
+            groupby=['dim1'], granularity='all', is_timeseries=False,
+            row_limit=10)
+        qry = get_query(client.topn, 'topn')
+        assert 'dimensions' not in qry and 'limit_spec' not in qry
+        assert qry['dimension'] == 'dim1'
+        assert qry['metric'] == 'count'
+        assert qry['threshold'] == 10
+        assert not client.groupby.called
+
+        # two phase query, the series are picked with a topN
+        client.topn.reset_mock()
+        query(
+            groupby=['dim1'], granularity='one day', is_timeseries=True,
+            timeseries_limit=5, row_limit=100)
+        pre_qry = get_query(client.topn, 'topn')
+        assert pre_qry['granularity'] == 'all'
+        assert pre_qry['threshold'] == 5
+        qry = get_query(client.groupby, 'groupby')
+        assert qry['dimensions'] == ['dim1']
+        assert qry['limit_spec']['limit'] == 100
+        assert Filter.build_filter(qry['filter']) == {
+            'type': 'in', 'dimension': 'dim1', 'values': ['a', 'b']}
+
     def test_add_filter(self, username='admin'):
         # navigate to energy_usage slice with "Electricity,heat" in filter values
         data = (
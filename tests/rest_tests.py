@@ -0,0 +1,199 @@
+"""Unit tests for the rest datasources of Caravel"""
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import base64
+import json
+import time
+import unittest
+
+from mock import Mock, patch
+
+from caravel import app
+from caravel.bl_models import RestClient, RestSession
+
+
+def make_token(claims):
+    """Builds an unsigned JWT token carrying the claims"""
+    def encode(obj):
+        data = json.dumps(obj).encode('utf-8')
+        return base64.urlsafe_b64encode(data).decode('ascii').rstrip('=')
+    return '.'.join([encode({'alg': 'none'}), encode(claims), 'signature'])
+
+
+def make_response(status_code=200, json_data=None):
+    resp = Mock(status_code=status_code, ok=status_code < 400, reason='')
+    resp.json.return_value = json_data
+    return resp
+
+
+class RestSessionTests(unittest.TestCase):
+
+    """Testing the authentication against the rest servers"""
+
+    def test_token_expiry(self):
+        exp = int(time.time()) + 600
+        assert RestSession.get_token_expiry(make_token({'exp': exp})) == (
+            exp - 30)
+        # tokens whose expiry can't be read are kept for REST_TOKEN_TIMEOUT
+        expiry = RestSession.get_token_expiry('not a token')
+        timeout = app.config.get('REST_TOKEN_TIMEOUT')
+        assert time.time() < expiry <= time.time() + timeout
+
+    @patch('caravel.bl_models.requests.Session')
+    def test_token_cache(self, Session):
+        tokens = [
+            make_token({'exp': int(time.time()) + 10}),
+            make_token({'exp': int(time.time()) + 600}),
+        ]
+        Session.return_value.post.side_effect = [
+            make_response(json_data={'jwtToken': token}) for token in tokens]
+        session = RestSession('localhost:8080')
+        # the first token expires within the 30 seconds of margin
+        assert session.get_access_token() == tokens[0]
+        assert session.get_access_token() == tokens[1]
+        assert session.get_access_token() == tokens[1]
+        assert Session.return_value.post.call_count == 2
+
+        url, = Session.return_value.post.call_args[0]
+        assert url == 'http://localhost:8080/login'
+
+    @patch('caravel.bl_models.requests.Session')
+    def test_login_failure(self, Session):
+        Session.return_value.post.return_value = make_response(401)
+        session = RestSession('localhost:8080')
+        assert session.get_access_token() is None
+
+    @patch('caravel.bl_models.requests.Session')
+    def test_relogin_on_401(self, Session):
+        tokens = [
+            make_token({'exp': int(time.time()) + 600, 'n': n})
+            for n in range(2)]
+        http = Session.return_value
+        http.post.side_effect = [
+            make_response(json_data={'jwtToken': token}) for token in tokens]
+        rejected = make_response(401)
+        accepted = make_response(200, {'result': []})
+        http.get.side_effect = [rejected, accepted]
+
+        session = RestSession('localhost:8080')
+        assert session.get('http://localhost:8080/api') is accepted
+        assert rejected.close.called
+        headers = [c[1]['headers'] for c in http.get.call_args_list]
+        assert headers == [
+            {'Authorization': tokens[0]}, {'Authorization': tokens[1]}]
+
+        # the renewed token is kept
+        http.get.side_effect = [accepted]
+        session.get('http://localhost:8080/api')
+        assert http.post.call_count == 2
+
+
+class RestClientTests(unittest.TestCase):
+
+    """Testing the decoding of the rest datasources' results"""
+
+    def stream(self, Session, body, reqparams):
+        """Streams the json body through a RestClient, in small chunks"""
+        data = json.dumps(body).encode('utf-8')
+        resp = make_response(200)
+        resp.iter_content.return_value = [
+            data[i:i + 7] for i in range(0, len(data), 7)]
+        Session.return_value.get.return_value = resp
+        Session.return_value.post.return_value = make_response(
+            json_data={'jwtToken': make_token({})})
+        server = Mock(server_url='stream_server:8080')
+        datasource = Mock(
+            database_type='mysql', database_name='db', table_name='tbl')
+        client = RestClient(server, datasource)
+        df = client.stream_dataframe(
+            'http://stream_server:8080/api', reqparams)
+        assert resp.close.called
+        return client, df
+
+    @patch('caravel.bl_models.requests.Session')
+    def test_stream_columnar_results(self, Session):
+        client, df = self.stream(Session, {
+            'query_type': 'groupby',
+            'result': {'name': ['a', 'b', 'c'], 'num': [1, 2, 3]},
+        }, {'row_limit': 2, 'result_format': 'columnar'})
+        assert client.query_type == 'groupby'
+        assert df.to_dict(orient='list') == {
+            'name': ['a', 'b'], 'num': [1, 2]}
+
+    @patch('caravel.bl_models.requests.Session')
+    def test_stream_rows(self, Session):
+        # rows whose values are all lists aren't columnar results
+        client, df = self.stream(Session, {
+            'query_type': 'groupby',
+            'result': [{'name': 'a', 'tags': ['x']}, {}, {'tags': ['y']}],
+        }, {})
+        assert df.to_dict(orient='list') == {
+            'name': ['a', None, None], 'tags': [['x'], None, ['y']]}
+
+    @patch('caravel.bl_models.requests.Session')
+    def test_stream_topn_row_limit(self, Session):
+        client, df = self.stream(Session, {
+            'query_type': 'topN',
+            'result': [
+                {'timestamp': '2016-01-01', 'result': [
+                    {'name': 'a', 'num': 3}, {'name': 'b', 'num': 2},
+                    {'name': 'c', 'num': 1}]},
+                {'timestamp': '2016-01-02', 'result': [
+                    {'name': 'a', 'num': 5}]},
+            ],
+        }, {'row_limit': 2})
+        assert df.to_dict(orient='list') == {
+            'name': ['a', 'b'], 'num': [3, 2],
+            'timestamp': ['2016-01-01', '2016-01-01']}
+
+    def export(self, query_type, result):
+        client = RestClient.__new__(RestClient)
+        client.query_type = query_type
+        client.result = result
+        return client.export_pandas()
+
+    def test_export_timeseries(self):
+        df = self.export('timeseries', [
+            {'timestamp': '2016-01-01', 'result': {'num': 1}},
+            {'timestamp': '2016-01-02', 'result': {'num': 2}},
+        ])
+        assert sorted(df.columns) == ['num', 'timestamp']
+        assert list(df['num']) == [1, 2]
+        assert list(df['timestamp']) == ['2016-01-01', '2016-01-02']
+
+    def test_export_topn(self):
+        df = self.export('topN', [
+            {'timestamp': '2016-01-01', 'result': [
+                {'name': 'a', 'num': 3}, {'name': 'b', 'num': 2}]},
+            {'timestamp': '2016-01-02', 'result': []},
+            {'timestamp': '2016-01-03', 'result': [{'name': 'a', 'num': 5}]},
+        ])
+        assert sorted(df.columns) == ['name', 'num', 'timestamp']
+        assert len(df) == 3
+        assert list(df['name']) == ['a', 'b', 'a']
+        # each row gets the timestamp of its bucket
+        assert list(df['timestamp']) == [
+            '2016-01-01', '2016-01-01', '2016-01-03']
+
+    def test_export_groupby(self):
+        df = self.export('groupby', [
+            {'name': 'a', 'num': 1}, {'name': 'b', 'num': 2}])
+        assert sorted(df.columns) == ['name', 'num']
+        assert len(df) == 2
+        assert list(df['name']) == ['a', 'b']
+
+    def test_export_columnar(self):
+        df = self.export('groupby', {'name': ['a', 'b'], 'num': [1, 2]})
+        assert df.to_dict(orient='list') == {
+            'name': ['a', 'b'], 'num': [1, 2]}
+
+    def test_export_unknown_query_type(self):
+        with self.assertRaises(NotImplementedError):
+            self.export('search', [{'name': 'a'}])
+
+
+if __name__ == '__main__':
+    unittest.main()
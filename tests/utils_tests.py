@@ -1,4 +1,5 @@
 from datetime import datetime, date, timedelta
+import json
 from caravel import utils
 import unittest
 
@@ -16,3 +17,135 @@ class UtilsTestCase(unittest.TestCase):
 
         with self.assertRaises(TypeError):
             utils.json_int_dttm_ser("this is not a date")
+
+    def test_cache_lock(self):
+        from mock import patch
+        from werkzeug.contrib.cache import SimpleCache
+        from caravel import app, cache
+        # the lock goes through the app's cache, as the visualizations do
+        with patch.dict(app.extensions['cache'], {cache: SimpleCache()}):
+            self.check_cache_lock(cache)
+
+    def check_cache_lock(self, cache):
+        lock = utils.CacheLock(cache, 'key__lock', timeout=60)
+        other = utils.CacheLock(cache, 'key__lock', timeout=60)
+        assert lock.acquire()
+        assert other.locked()
+        assert not other.acquire()
+        # only the holder can release the lock
+        other.release()
+        assert lock.locked()
+        lock.release()
+        assert not other.locked()
+        assert other.acquire()
+
+    def test_cache_semaphore(self):
+        from werkzeug.contrib.cache import SimpleCache
+        cache = SimpleCache()
+
+        def semaphore():
+            return utils.CacheSemaphore(
+                cache, 'db', 2, timeout=60, reserved=1)
+
+        interactive = semaphore()
+        background = semaphore()
+        assert background.acquire(low_priority=True)
+        # the reserved slot is left to the interactive requests
+        assert not semaphore().acquire(low_priority=True)
+        assert interactive.acquire()
+        assert not semaphore().acquire()
+
+        waits = []
+        slots = utils.SemaphoreSlots(
+            [semaphore()], timeout=0.1, on_wait=lambda: waits.append(1),
+            interval=0.01)
+        with self.assertRaises(utils.CaravelException):
+            slots.acquire()
+        assert waits
+
+        background.release()
+        with slots:
+            assert not semaphore().acquire()
+        assert semaphore().acquire()
+
+    def test_semaphore_slots_refresh(self):
+        from mock import Mock
+        from werkzeug.contrib.cache import SimpleCache
+        cache = SimpleCache()
+        semaphore = utils.CacheSemaphore(cache, 'db', 1, timeout=60)
+        with utils.SemaphoreSlots([semaphore]) as slots:
+            lock = semaphore.lock
+            cache.set = Mock(wraps=cache.set)
+            slots.refresh()
+            cache.set.assert_called_once_with(
+                lock.key, lock.token, timeout=60)
+
+            # a slot lost to its timeout isn't taken back
+            cache.delete(lock.key)
+            other = utils.CacheSemaphore(cache, 'db', 1, timeout=60)
+            assert other.acquire()
+            slots.refresh()
+            assert cache.get(lock.key) == other.lock.token
+
+    def test_lru_cache(self):
+        cache = utils.LRUCache(10)
+        cache.set('a', 'aaaa')
+        cache.set('b', 'bbbb')
+        assert cache.get('a') == 'aaaa'
+        # 'b' is the least recently used entry
+        cache.set('c', 'cccc')
+        assert cache.get('b') is None
+        assert cache.get('a') == 'aaaa'
+        assert cache.get('c') == 'cccc'
+        assert cache.size == 8
+
+        assert not cache.set('d', 'd' * 11)
+        assert cache.get('d') is None
+
+        cache.set('a', 'aaaa', timeout=-1)
+        assert cache.get('a') is None
+        assert cache.size == 4
+
+    def test_shared_results(self):
+        calls = []
+
+        def compute():
+            calls.append(1)
+            return len(calls)
+
+        results = utils.SharedResults()
+        values = list(utils.parallel_imap(
+            lambda key: results.get(key, compute), ['a', 'a', 'a', 'b']))
+        assert sorted(values) == [1, 1, 1, 2] or sorted(values) == [1, 2, 2, 2]
+        assert len(calls) == 2
+
+    def test_json_object_stream(self):
+        data = (
+            b'{"result": [{"timestamp": "2016-01-01", "result": {"a": 1}}, '
+            b'{"timestamp": "2016-01-02", "result": {"a": 2.5e3}}], '
+            b'"query_type": "timeseries", "empty": []}')
+        expected = [
+            ('result', {'timestamp': '2016-01-01', 'result': {'a': 1}}),
+            ('result', {'timestamp': '2016-01-02', 'result': {'a': 2500.0}}),
+            ('query_type', 'timeseries'),
+            ('empty', []),
+        ]
+        for size in (1, 3, 7, len(data)):
+            chunks = [data[i:i + size] for i in range(0, len(data), size)]
+            assert list(utils.JSONObjectStream(chunks, 'result')) == expected
+
+        with self.assertRaises(ValueError):
+            list(utils.JSONObjectStream([b'{"result": [1, 2'], 'result'))
+
+    def test_json_object_stream_large_value(self):
+        from mock import Mock
+        value = {'a': list(range(10000)), 'b': ['x'] * 10000}
+        data = json.dumps({'result': value, 'query_type': 'groupby'})
+        data = data.encode('utf-8')
+        chunks = [data[i:i + 100] for i in range(0, len(data), 100)]
+        stream = utils.JSONObjectStream(chunks, 'result')
+        stream.decoder = Mock(wraps=stream.decoder)
+        assert list(stream) == [
+            ('result', value), ('query_type', 'groupby')]
+        # values that aren't streamed aren't decoded once per chunk
+        assert stream.decoder.raw_decode.call_count < 20